@@ -0,0 +1,17 @@
+"""
+Benchmarks for the overhead of django-simple-history.
+
+Run them from the repository root with:
+
+    python -m benchmarks.run [save|m2m|as_of|admin ...] > results.json
+
+They run against a local SQLite database by default. Set
+DJANGO_SETTINGS_MODULE=benchmarks.settings_postgresql to run them against
+PostgreSQL, and BENCH_MAX_DEPTH to skip the deepest histories (up to
+1,000,000 records per object).
+
+    python -m benchmarks.check_queries
+
+checks that the admin history view runs the same number of queries no
+matter how deep the history is, and exits with status 1 otherwise.
+"""
@@ -0,0 +1,25 @@
+"""
+Render time of the admin history view as the history of an object grows.
+"""
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.test.client import RequestFactory
+from benchmarks.app.models import Item
+from benchmarks.utils import get_depths, make_history, measure
+
+DEPTHS = (10, 1000, 100000)
+
+
+def run(depths=DEPTHS, repeat=20):
+    import benchmarks.urls
+    model_admin = admin.site._registry[Item]
+    request = RequestFactory().get('/')
+    request.user = User.objects.create_superuser('bench', 'bench@example.com', 'bench')
+    results = []
+    for depth in get_depths(depths):
+        item = Item.objects.create(name='history_view %d' % depth)
+        make_history(item, depth)
+        timing = measure(lambda: model_admin.history_view(request, str(item.pk)), repeat)
+        timing.update({'benchmark': 'admin_history_view', 'depth': depth})
+        results.append(timing)
+    return results
@@ -0,0 +1,45 @@
+from django.db import models
+from simple_history.models import HistoricalRecords
+
+
+class Item(models.Model):
+    name = models.CharField(max_length=100)
+    quantity = models.IntegerField(default=0)
+    description = models.TextField(blank=True)
+
+    history = HistoricalRecords()
+
+
+class PlainItem(models.Model):
+    """
+    Same as Item, without history, to measure the overhead of recording it.
+    """
+    name = models.CharField(max_length=100)
+    quantity = models.IntegerField(default=0)
+    description = models.TextField(blank=True)
+
+
+class Category(models.Model):
+    name = models.CharField(max_length=100)
+
+    history = HistoricalRecords()
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=100)
+
+    history = HistoricalRecords()
+
+
+class Box(models.Model):
+    """
+    Has a historical FK and m2m relation, for as_of_related() and m2m
+    changes.
+    """
+    name = models.CharField(max_length=100)
+    quantity = models.IntegerField(default=0)
+    category = models.ForeignKey(Category, null=True)
+    tags = models.ManyToManyField(Tag)
+    m2m_history_fields = ['tags']
+
+    history = HistoricalRecords()
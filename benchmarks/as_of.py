@@ -0,0 +1,26 @@
+"""
+as_of(), most_recent() and as_of_related() latency as the history of a
+single object grows.
+"""
+from benchmarks.app.models import Box, Category, Item
+from benchmarks.utils import get_depths, make_history, measure
+
+DEPTHS = (10, 100, 1000, 10000, 100000, 1000000)
+
+
+def run(depths=DEPTHS, repeat=100):
+    results = []
+    for depth in get_depths(depths):
+        item = Item.objects.create(name='as_of %d' % depth)
+        middle = make_history(item, depth)
+        category = Category.objects.create(name='as_of_related %d' % depth)
+        make_history(category, 10)
+        box = Box.objects.create(name='as_of_related %d' % depth, category=category)
+        make_history(box, depth)
+        for name, func in (('as_of', lambda: item.history.as_of(middle)),
+                           ('most_recent', lambda: item.history.most_recent()),
+                           ('as_of_related', lambda: box.history.as_of_related(middle).category)):
+            timing = measure(func, repeat)
+            timing.update({'benchmark': name, 'depth': depth})
+            results.append(timing)
+    return results
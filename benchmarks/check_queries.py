@@ -0,0 +1,73 @@
+"""
+Checks that the admin history view runs as many queries for deep
+histories as for shallow ones, both on the first page and on a page deep
+into the history. Prints the counts and exits with status 1 if they
+differ:
+
+    python -m benchmarks.check_queries
+"""
+import os
+import sys
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+DEPTHS = (10, 1000, 100000)
+
+
+def count_queries(func):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    with CaptureQueriesContext(connection) as queries:
+        func()
+    return len(queries)
+
+
+def check(depths=DEPTHS):
+    """
+    Returns the number of queries of the first page and of a deep page of
+    the history view, per depth.
+    """
+    from django.contrib import admin
+    from django.contrib.auth.models import User
+    from django.test.client import RequestFactory
+    import benchmarks.urls
+    from benchmarks.app.models import Item
+    from benchmarks.utils import get_depths, make_history
+    from simple_history.admin import history_cursor
+
+    model_admin = admin.site._registry[Item]
+    user = User.objects.create_superuser('check', 'check@example.com', 'check')
+    counts = {}
+    for depth in get_depths(depths):
+        item = Item.objects.create(name='check_queries %d' % depth)
+        make_history(item, depth)
+        # The page before the middle record.
+        middle = item.history.order_by('history_date', 'history_id')[depth // 2]
+        pages = (('first', {}), ('deep', {'before': history_cursor(middle)}))
+        for page, params in pages:
+            request = RequestFactory().get('/', params)
+            request.user = user
+            counts[page, depth] = count_queries(
+                lambda: model_admin.history_view(request, str(item.pk)))
+    return counts
+
+
+def main():
+    from benchmarks.run import setup_database
+
+    setup_database()
+    counts = check()
+    failed = False
+    for page in ('first', 'deep'):
+        found = sorted((depth, count) for (name, depth), count in counts.items()
+                       if name == page)
+        line = ', '.join('%d records: %d queries' % item for item in found)
+        if len(set(count for depth, count in found)) > 1:
+            failed = True
+            line += ' -- FAILED, the count grows with the history'
+        sys.stdout.write('%s page: %s\n' % (page, line))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
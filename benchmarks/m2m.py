@@ -0,0 +1,24 @@
+"""
+Time spent in m2m add() and clear() with history recorded through
+m2m_changed.
+"""
+from benchmarks.app.models import Box, Tag
+from benchmarks.utils import measure
+
+SIZES = (1, 10, 100)
+
+
+def run(sizes=SIZES, repeat=100):
+    results = []
+    for size in sizes:
+        tags = [Tag.objects.create(name='tag %d' % i) for i in range(size)]
+        box = Box.objects.create(name='m2m %d' % size)
+        timing = measure(lambda: box.tags.add(*tags), repeat,
+                         setup=lambda: box.tags.clear())
+        timing.update({'benchmark': 'm2m_add', 'size': size})
+        results.append(timing)
+        timing = measure(lambda: box.tags.clear(), repeat,
+                         setup=lambda: box.tags.add(*tags))
+        timing.update({'benchmark': 'm2m_clear', 'size': size})
+        results.append(timing)
+    return results
@@ -0,0 +1,51 @@
+"""
+Runs the benchmarks given on the command line (all of them by default)
+against a fresh database and prints the results as JSON, along with the
+versions and database they ran with.
+"""
+import json
+import os
+import platform
+import sys
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+
+BENCHMARKS = ('save', 'm2m', 'as_of', 'admin')
+
+
+def setup_database():
+    """
+    Creates the benchmark tables in an empty database.
+    """
+    from django.conf import settings
+    from django.core.management import call_command
+
+    database = settings.DATABASES['default']
+    if database['ENGINE'].endswith('sqlite3') and os.path.exists(database['NAME']):
+        os.remove(database['NAME'])
+    call_command('syncdb', interactive=False, verbosity=0)
+    call_command('flush', interactive=False, verbosity=0)
+
+
+def main(names):
+    import django
+    from django.db import connection
+    from django.utils import importlib
+
+    setup_database()
+    results = []
+    for name in names or BENCHMARKS:
+        module = importlib.import_module('benchmarks.%s' % name)
+        results.extend(module.run())
+    environment = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'database': connection.vendor,
+        'max_depth': os.environ.get('BENCH_MAX_DEPTH'),
+    }
+    json.dump({'environment': environment, 'results': results}, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
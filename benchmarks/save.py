@@ -0,0 +1,19 @@
+"""
+Time spent in save() with and without history.
+"""
+from benchmarks.app.models import Item, PlainItem
+from benchmarks.utils import measure
+
+
+def run(repeat=1000):
+    results = []
+    for model in (PlainItem, Item):
+        obj = model.objects.create(name='save')
+
+        def save():
+            obj.quantity += 1
+            obj.save()
+        timing = measure(save, repeat)
+        timing.update({'benchmark': 'save', 'model': model.__name__})
+        results.append(timing)
+    return results
@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('BENCH_SQLITE_NAME',
+                               os.path.join(tempfile.gettempdir(), 'simple_history_bench.sqlite3')),
+    },
+}
+
+INSTALLED_APPS = (
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'django.contrib.admin',
+    'simple_history',
+    'benchmarks.app',
+)
+
+ROOT_URLCONF = 'benchmarks.urls'
+SECRET_KEY = 'simple_history benchmarks'
+USE_TZ = False
@@ -0,0 +1,21 @@
+"""
+Runs the benchmarks against PostgreSQL:
+
+    DJANGO_SETTINGS_MODULE=benchmarks.settings_postgresql python -m benchmarks.run
+
+The database is configured with the BENCH_PG_* environment variables. Its
+tables are flushed before every run.
+"""
+import os
+from benchmarks.settings import *
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'NAME': os.environ.get('BENCH_PG_NAME', 'simple_history_bench'),
+        'USER': os.environ.get('BENCH_PG_USER', ''),
+        'PASSWORD': os.environ.get('BENCH_PG_PASSWORD', ''),
+        'HOST': os.environ.get('BENCH_PG_HOST', ''),
+        'PORT': os.environ.get('BENCH_PG_PORT', ''),
+    },
+}
@@ -0,0 +1,8 @@
+from django.conf.urls import include, patterns, url
+from django.contrib import admin
+from simple_history.admin import SimpleHistoryAdmin
+from benchmarks.app.models import Item
+
+admin.site.register(Item, SimpleHistoryAdmin)
+
+urlpatterns = patterns('', url(r'^admin/', include(admin.site.urls)))
@@ -0,0 +1,48 @@
+import datetime
+import os
+import timeit
+
+
+def measure(func, repeat=100, setup=None):
+    """
+    Calls `func` `repeat` times and returns the mean and best time per
+    call, in milliseconds. `setup` is called before every call, untimed.
+    """
+    timings = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = timeit.default_timer()
+        func()
+        timings.append((timeit.default_timer() - start) * 1000)
+    return {'mean_ms': sum(timings) / len(timings), 'min_ms': min(timings)}
+
+
+def get_depths(depths):
+    """
+    Returns the history depths up to the BENCH_MAX_DEPTH environment
+    variable, if set.
+    """
+    max_depth = os.environ.get('BENCH_MAX_DEPTH')
+    if not max_depth:
+        return depths
+    return tuple(depth for depth in depths if depth <= int(max_depth))
+
+
+def make_history(obj, depth, chunk_size=10000):
+    """
+    Writes `depth` historical records for `obj`, one minute apart from
+    2000-01-01 on, and returns the date of the middle one.
+    """
+    history_model = obj.__class__.history.model
+    values = dict((name, getattr(obj, name))
+                  for name in history_model.history_field_plan.tracked)
+    start = datetime.datetime(2000, 1, 1)
+    for offset in range(0, depth, chunk_size):
+        records = []
+        for i in range(offset, min(depth, offset + chunk_size)):
+            records.append(history_model(
+                history_date=start + datetime.timedelta(minutes=i),
+                history_type=i and '~' or '+', **values))
+        history_model.objects.bulk_create(records)
+    return start + datetime.timedelta(minutes=depth // 2)
@@ -1,23 +1,42 @@
 import importlib
 import models
+from batch import history_batch
 
 
 registered_models = {}
 
 
-def register(model, app=None, manager_name='history'):
+def register(model, app=None, manager_name='history', fields=None, exclude=(),
+             indexes=(), checkpoint_every=None, skip_unchanged=False,
+             retention=None, using=None, partition_by=None):
     """
     Create historical model for `model` and attach history manager to `model`.
 
     Keyword arguments:
     app -- App to install historical model into (defaults to model.__module__)
     manager_name -- class attribute name to use for historical manager
+    fields -- names of the fields to record (defaults to all fields)
+    exclude -- names of fields not to record
+    indexes -- extra tuples of field names to index on the historical model
+    checkpoint_every -- store only changed fields, with a full record every
+                        this many records (defaults to always full records)
+    skip_unchanged -- don't record saves that left every field as it was
+                      when the instance was loaded or last saved
+    retention -- timedelta after which prune_history deletes records
+    using -- database alias to keep the historical records in
+    partition_by -- 'month' or 'year' to keep records in one table per period
 
     This method should be used as an alternative to attaching an
     `HistoricalManager` instance directly to `model`.
     """
     if not model in registered_models:
-        records = models.HistoricalRecords()
+        records = models.HistoricalRecords(fields=fields, exclude=exclude,
+                                           indexes=indexes,
+                                           checkpoint_every=checkpoint_every,
+                                           skip_unchanged=skip_unchanged,
+                                           retention=retention,
+                                           using=using,
+                                           partition_by=partition_by)
         records.manager_name = manager_name
         records.module = ("%s.models" % app) if app else model.__module__
         records.finalize(model)
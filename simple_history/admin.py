@@ -1,22 +1,65 @@
-from django import template
-from django.db import models
+import datetime
+from django import forms, template
+from django.db import models, router, transaction
 from django.conf.urls import patterns, url
 from django.conf import settings
-from django.contrib import admin
+from django.contrib import admin, messages
 from django.contrib.admin import helpers
+from django.core.exceptions import PermissionDenied
+from django.http import Http404
 from django.contrib.contenttypes.models import ContentType
 from django.core.urlresolvers import reverse
 from django.shortcuts import get_object_or_404, render_to_response
 from django.contrib.admin.util import unquote
+from django.contrib.auth.models import User
 from django.utils.text import capfirst
 from django.utils.html import mark_safe
-from django.utils.translation import ugettext as _
+from django.utils.translation import ugettext as _, ugettext_lazy
 from django.utils.encoding import force_unicode
+from django.utils import timezone
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+def history_cursor(record):
+    """
+    Returns the pagination cursor identifying `record` in the history view.
+    """
+    date = record.history_date
+    if timezone.is_aware(date):
+        date = timezone.make_naive(date, timezone.utc)
+    return '%s-%s' % (date.strftime(CURSOR_DATE_FORMAT), record.history_id)
+
+
+def parse_history_cursor(cursor):
+    """
+    Returns the (history_date, history_id) of a cursor made by
+    history_cursor(), or None. Raises ValueError if it's malformed.
+    """
+    if not cursor:
+        return None
+    date, history_id = cursor.split('-')
+    date = datetime.datetime.strptime(date, CURSOR_DATE_FORMAT)
+    if settings.USE_TZ:
+        date = timezone.make_aware(date, timezone.utc)
+    return date, int(history_id)
+
+
+class RevertForm(forms.Form):
+    date = forms.DateTimeField(label=ugettext_lazy('Revert to the state as of'))
 
 
 class SimpleHistoryAdmin(admin.ModelAdmin):
     object_history_template = "simple_history/object_history.html"
     object_history_form_template = "simple_history/object_history_form.html"
+    revert_selected_template = "simple_history/revert_selected_confirmation.html"
+    actions = ['revert_selected']
+    # Fields of the historical records shown in the history view.
+    history_list_fields = ('history_date', 'history_type', 'changed_by')
+    history_list_per_page = 100
+    # How the history view counts the records: 'exact', 'estimated' (from
+    # the query planner, where the database provides one) or None.
+    history_list_count = 'exact'
 
     def get_urls(self):
         """Returns the additional urls used by the Reversion admin."""
@@ -37,12 +80,26 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         app_label = opts.app_label
         pk_name = opts.pk.attname
         history = getattr(model, model._meta.simple_history_manager_attribute)
-        action_list = history.filter(**{pk_name: object_id})
         # If no history was found, see whether this object even exists.
         obj = get_object_or_404(model, pk=unquote(object_id))
+        action_list, newer, older = self.get_history_page(
+            history, object_id, request.GET.get('before'), request.GET.get('after'))
+        count = None
+        if self.history_list_count:
+            querysets = [qs.filter(**{pk_name: object_id})
+                         for qs in history.partition_querysets()]
+            if self.history_list_count == 'estimated':
+                count = sum(qs.estimated_count() for qs in querysets)
+            else:
+                count = sum(qs.count() for qs in querysets)
         context = {
             'title': _('Change history: %s') % force_unicode(obj),
             'action_list': action_list,
+            'history_count': count,
+            'show_history_count': count is not None,
+            'history_count_estimated': self.history_list_count == 'estimated',
+            'newer_url': newer and action_list and '?after=%s' % history_cursor(action_list[0]),
+            'older_url': older and action_list and '?before=%s' % history_cursor(action_list[-1]),
             'module_name': capfirst(force_unicode(opts.verbose_name_plural)),
             'object': obj,
             'app_label': app_label,
@@ -52,6 +109,83 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         context_instance = template.RequestContext(request, current_app=self.admin_site.name)
         return render_to_response(self.object_history_template, context, context_instance=context_instance)
 
+    def get_history_page(self, history, object_id, before=None, after=None):
+        """
+        Returns one page of the object's historical records, newest first,
+        and whether there are newer and older records. Pages are found with
+        keyset pagination on (history_date, history_id), starting right
+        before or after the record identified by the `before` or `after`
+        cursor, so deep pages cost the same as the first one.
+        """
+        per_page = self.history_list_per_page
+        try:
+            cursor = parse_history_cursor(after or before)
+        except ValueError:
+            cursor, after = None, None
+        if cursor is None:
+            querysets, ordering, condition = history.partition_querysets(), '-', None
+        elif after:
+            date, history_id = cursor
+            querysets = history.partition_querysets()[::-1]
+            ordering = ''
+            condition = (models.Q(history_date__gt=date) |
+                         models.Q(history_date=date, history_id__gt=history_id))
+        else:
+            date, history_id = cursor
+            querysets = history.partition_querysets(until=date)
+            ordering = '-'
+            condition = (models.Q(history_date__lt=date) |
+                         models.Q(history_date=date, history_id__lt=history_id))
+        pk_name = self.model._meta.pk.attname
+        records = []
+        for qs in querysets:
+            qs = self.history_list_queryset(qs.filter(**{pk_name: object_id}))
+            if condition is not None:
+                qs = qs.filter(condition)
+            qs = qs.order_by(ordering + 'history_date', ordering + 'history_id')
+            records.extend(qs[:per_page + 1 - len(records)])
+            if len(records) > per_page:
+                break
+        more = len(records) > per_page
+        records = records[:per_page]
+        if cursor is not None and after:
+            if not more:
+                # Back at the newest records: show a full first page.
+                return self.get_history_page(history, object_id)
+            records.reverse()
+            has_newer, has_older = True, True
+        else:
+            has_newer, has_older = cursor is not None, more
+        self.prefetch_history_users(records)
+        return records, has_newer, has_older
+
+    def history_list_queryset(self, qs):
+        """
+        Returns the queryset of historical records listed in the history
+        view, loading only the fields in `history_list_fields` (and those
+        needed for the links) and the users who made the changes.
+        """
+        fields = set(self.history_list_fields)
+        fields.update([self.model._meta.pk.attname, 'history_id', 'history_date'])
+        qs = qs.only(*fields)
+        if 'changed_by' in fields and qs.db == router.db_for_read(User):
+            qs = qs.select_related('changed_by')
+        return qs
+
+    def prefetch_history_users(self, records):
+        """
+        Sets the users of records read from another database than the
+        users, which can't be joined, with a single query.
+        """
+        if 'changed_by' not in self.history_list_fields or not records:
+            return
+        cache_name = records[0]._meta.get_field('changed_by').get_cache_name()
+        missing = [record for record in records if not hasattr(record, cache_name)]
+        ids = set(record.changed_by_id for record in missing) - set([None])
+        users = User._default_manager.in_bulk(list(ids)) if ids else {}
+        for record in missing:
+            setattr(record, cache_name, users.get(record.changed_by_id))
+
     def history_form_view(self, request, object_id, version_id):
         original_model = self.model
         original_opts = original_model._meta
@@ -60,6 +194,15 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         opts = model._meta
         app_label = opts.app_label
         pk_name = original_opts.pk.attname
+        partitions = model.history_partitions
+        if partitions is not None and '-' in version_id:
+            # Records of partitioned models are identified by partition too.
+            partition, version_id = version_id.split('-', 1)
+            if partition not in partitions.existing_keys():
+                raise Http404
+            model = partitions.get_model(partition)
+        if not version_id.isdigit():
+            raise Http404
         record = get_object_or_404(model, **{pk_name: object_id, 'history_id': version_id})
         original = get_object_or_404(original_model, pk=object_id)
         original_history = getattr(original, self.model._meta.simple_history_manager_attribute)
@@ -135,6 +278,64 @@ class SimpleHistoryAdmin(admin.ModelAdmin):
         context_instance = template.RequestContext(request, current_app=self.admin_site.name)
         return render_to_response(self.object_history_form_template, context, context_instance)
 
+    def revert_selected(self, request, queryset):
+        """
+        Reverts the selected objects to their state as of a date, asked for
+        on an intermediate page, with HistoryManager.revert_to(). Reverts
+        that would add or delete objects the user may not add or delete are
+        rolled back.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        opts = self.model._meta
+        form = RevertForm(request.POST if request.POST.get('post') else None)
+        if form.is_valid():
+            date = form.cleaned_data['date']
+            history = getattr(self.model, opts.simple_history_manager_attribute)
+            objects = dict((obj.pk, obj) for obj in queryset)
+            try:
+                with transaction.atomic(using=queryset.db):
+                    result = history.revert_to(date, queryset, changed_by=request.user)
+                    if ((result['deleted'] and not self.has_delete_permission(request)) or
+                            (result['created'] and not self.has_add_permission(request))):
+                        raise PermissionDenied
+            except PermissionDenied:
+                self.message_user(request, _('Reverting these %(name)s to %(date)s would add or '
+                                             'delete some of them, which you may not do.') % {
+                    'name': force_unicode(opts.verbose_name_plural),
+                    'date': date,
+                }, level=messages.ERROR)
+                return None
+            message = _('Reverted to %s.') % date
+            reverted = self.model._default_manager.using(queryset.db).in_bulk(
+                result['updated'] + result['created'])
+            for pk in result['updated']:
+                self.log_change(request, reverted[pk], message)
+            for pk in result['created']:
+                self.log_addition(request, reverted[pk])
+            for pk in result['deleted']:
+                self.log_deletion(request, objects[pk], force_unicode(objects[pk]))
+            self.message_user(request, _('%(updated)d %(name)s updated, %(created)d created '
+                                         'and %(deleted)d deleted.') % {
+                'name': force_unicode(opts.verbose_name_plural),
+                'updated': len(result['updated']),
+                'created': len(result['created']),
+                'deleted': len(result['deleted']),
+            })
+            return None
+        context = {
+            'title': _('Revert %s') % force_unicode(opts.verbose_name_plural),
+            'objects_name': force_unicode(opts.verbose_name_plural),
+            'queryset': queryset,
+            'form': form,
+            'opts': opts,
+            'app_label': opts.app_label,
+            'action_checkbox_name': helpers.ACTION_CHECKBOX_NAME,
+        }
+        context_instance = template.RequestContext(request, current_app=self.admin_site.name)
+        return render_to_response(self.revert_selected_template, context, context_instance)
+    revert_selected.short_description = ugettext_lazy('Revert selected %(verbose_name_plural)s to a date')
+
     def save_model(self, request, obj, form, change):
         """
         Add the admin user to a special model attribute for reference after save
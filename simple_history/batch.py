@@ -0,0 +1,236 @@
+import sys
+import threading
+from functools import wraps
+from django.db import transaction
+from django.utils.datastructures import SortedDict
+from manager import get_history_db
+import cache
+import commit_hooks
+import writer
+
+_state = threading.local()
+
+
+def current_batch():
+    """
+    Returns the innermost active HistoryBatch for this thread, or None.
+    """
+    stack = getattr(_state, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+class HistoryBatch(object):
+    """
+    Buffers unsaved historical records per history model while a
+    transaction is open, and writes them with one bulk INSERT per
+    history model right before the transaction commits.
+
+    Can be used either as a context manager or as a decorator:
+
+        with history_batch():
+            for obj in objects:
+                obj.save()
+
+    The block runs inside `transaction.atomic`, so the historical rows
+    are committed together with the rows they describe. If the block
+    raises, the buffered rows are discarded along with the transaction.
+    Nested batches buffer separately and hand their rows over to the
+    enclosing batch on success, so a rolled back savepoint drops only
+    its own rows. The same goes for rows buffered inside a plain
+    `transaction.atomic` block: they're dropped if it rolls back.
+
+    Note that buffered records don't have a `history_id` until the
+    batch is flushed.
+    """
+    def __init__(self, using=None):
+        self.using = using
+        self.records = SortedDict()
+        self.by_object = {}
+
+    def add(self, record):
+        if not hasattr(record, '_history_savepoints'):
+            record._history_savepoints = commit_hooks.savepoint_ids(self.using)
+        model = record.__class__
+        self.records.setdefault(model, []).append(record)
+        pk = getattr(record, record.instance_type._meta.pk.attname)
+        self.by_object.setdefault((model, pk), []).append(record)
+
+    def pending(self, model, pk):
+        """
+        Returns the buffered records of `model` for the object with primary
+        key `pk`, oldest first.
+        """
+        return self.by_object.get((model, pk), [])
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def flush(self):
+        """
+        Writes every buffered record, one bulk INSERT per history model.
+        Models are flushed in the order they were first seen and records
+        keep the order they were added in, so `history_id` still grows
+        with `history_date`.
+        """
+        records = self.records
+        self.discard()
+        for model, rows in records.items():
+            model._default_manager.bulk_create(rows)
+            cache.invalidate_records(rows)
+
+    def flush_model(self, model):
+        """
+        Writes the buffered records of one history model right away, for
+        when records of that model are about to be written around the
+        batch.
+        """
+        rows = self.records.pop(model, None)
+        if not rows:
+            return
+        for key in [key for key in self.by_object if key[0] is model]:
+            del self.by_object[key]
+        model._default_manager.bulk_create(rows)
+        cache.invalidate_records(rows)
+
+    def take_records(self, condition):
+        """
+        Removes and returns the buffered records of the history models
+        for which `condition(model)` is true.
+        """
+        records = []
+        for model in list(self.records):
+            if condition(model):
+                records.extend(self.records.pop(model))
+        return records
+
+    def discard(self):
+        self.records = SortedDict()
+        self.by_object = {}
+
+    def rolled_back(self, sid):
+        """
+        Drops the records buffered while the savepoint `sid` was active, or
+        every record if the whole transaction was rolled back.
+        """
+        if sid is None:
+            self.rolled_back_all = True
+            self.discard()
+            return
+        records = [record for rows in self.records.values() for record in rows]
+        self.discard()
+        self.extend(record for record in records if sid not in record._history_savepoints)
+
+    def __enter__(self):
+        self.outermost = not transaction.get_connection(self.using).in_atomic_block
+        self.rolled_back_all = False
+        self.atomic = transaction.atomic(using=self.using)
+        self.atomic.__enter__()
+        commit_hooks.add_rollback_listener(self.rolled_back, using=self.using)
+        if not hasattr(_state, 'stack'):
+            _state.stack = []
+        _state.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _state.stack.pop()
+        background = writer.get_writer()
+        connection = transaction.get_connection(self.using)
+        alias = connection.alias
+        queued, later = [], []
+        try:
+            if (exc_type is not None or connection.needs_rollback
+                    or connection.closed_in_transaction):
+                # Either way the transaction is going to be rolled back.
+                self.discard()
+            else:
+                parent = current_batch()
+                if parent is not None and parent.using == self.using:
+                    for rows in self.records.values():
+                        parent.extend(rows)
+                    self.discard()
+                else:
+                    # Records for the background writer, and records kept in
+                    # another database, are written once this transaction
+                    # is committed.
+                    if background is not None and self.outermost:
+                        queued = self.take_records(
+                            lambda model: not getattr(model, 'history_checkpoint_every', None))
+                    later = self.take_records(lambda model: get_history_db(model) != alias)
+                    self.flush()
+        except:
+            self.exit_atomic(*sys.exc_info())
+            raise
+        result = self.exit_atomic(exc_type, exc_value, traceback)
+        if (queued or later) and not self.rolled_back_all:
+            # Whatever doesn't fit in the queue is written right away.
+            if queued:
+                self.extend(background.put(queued))
+            deferred = deferred_batch(self.using, create=bool(later))
+            if deferred is not None:
+                # An enclosing transaction is still open.
+                deferred.extend(later)
+            else:
+                self.extend(later)
+            self.flush()
+        return result
+
+    def exit_atomic(self, exc_type, exc_value, traceback):
+        try:
+            return self.atomic.__exit__(exc_type, exc_value, traceback)
+        finally:
+            commit_hooks.remove_rollback_listener(self.rolled_back, using=self.using)
+
+    def __call__(self, func):
+        @wraps(func)
+        def inner(*args, **kwargs):
+            with self.__class__(using=self.using):
+                return func(*args, **kwargs)
+        return inner
+
+
+def deferred_batch(using=None, create=False):
+    """
+    Returns the batch buffering the records that are kept in another
+    database than `using`, while a transaction is open on `using` outside
+    of history_batch(). They're written once that transaction commits, or
+    dropped along with the savepoints they were made in, so that history
+    never outlives the changes it records.
+
+    Returns None in autocommit mode, or if there's no such batch and not
+    `create`.
+    """
+    connection = transaction.get_connection(using)
+    if not connection.in_atomic_block:
+        return None
+    batch = connection.__dict__.get('_history_deferred_batch')
+    if batch is None and create:
+        batch = connection.__dict__['_history_deferred_batch'] = HistoryBatch(using)
+
+        def committed():
+            ended()
+            batch.flush()
+
+        def ended(sid=None):
+            if sid is None:
+                del connection.__dict__['_history_deferred_batch']
+                commit_hooks.remove_commit_listener(committed, using=using)
+                commit_hooks.remove_rollback_listener(batch.rolled_back, using=using)
+                commit_hooks.remove_rollback_listener(ended, using=using)
+
+        commit_hooks.add_commit_listener(committed, using=using)
+        commit_hooks.add_rollback_listener(batch.rolled_back, using=using)
+        commit_hooks.add_rollback_listener(ended, using=using)
+    return batch
+
+
+def history_batch(using=None):
+    """
+    Opt-in batched history writes for the duration of a transaction.
+    See HistoryBatch for details.
+    """
+    if callable(using):
+        return HistoryBatch()(using)
+    return HistoryBatch(using=using)
@@ -0,0 +1,142 @@
+"""
+Optional in-process cache for as_of() lookups.
+
+Historical records before a given date don't change once written, so the
+state of an object as of that date can be cached:
+
+    from simple_history import cache
+    cache.enable(max_size=10000)
+
+Entries are keyed by (history model, pk, date) and evicted least recently
+used first. Writing a historical record for an object only invalidates the
+cached entries of that object for dates on or after the record's date.
+Lookups made inside a transaction aren't cached, since they may read
+records that get rolled back. `stats()` returns the hit and miss counters.
+"""
+import threading
+from collections import OrderedDict, defaultdict
+
+
+class AsOfCache(object):
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.dates = defaultdict(set)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, model, pk, date):
+        """
+        Returns the cached value, or raises KeyError.
+        """
+        key = (model, pk, date)
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                raise
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, model, pk, date, value):
+        key = (model, pk, date)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            self.dates[model, pk].add(date)
+            while len(self.entries) > self.max_size:
+                (model, pk, date), value = self.entries.popitem(last=False)
+                self._forget_date(model, pk, date)
+
+    def invalidate(self, model, pk, date):
+        """
+        Drops the entries of an object for dates on or after `date`.
+        """
+        with self.lock:
+            dates = self.dates.get((model, pk))
+            if not dates:
+                return
+            for cached_date in [d for d in dates if d >= date]:
+                self.entries.pop((model, pk, cached_date), None)
+                self._forget_date(model, pk, cached_date)
+
+    def invalidate_model(self, model, date):
+        """
+        Drops the entries of every object of `model` for dates on or after
+        `date`, for changes whose objects aren't known one by one.
+        """
+        with self.lock:
+            for key in [key for key in self.entries
+                        if key[0] is model and key[2] >= date]:
+                del self.entries[key]
+                self._forget_date(*key)
+
+    def _forget_date(self, model, pk, date):
+        dates = self.dates[model, pk]
+        dates.discard(date)
+        if not dates:
+            del self.dates[model, pk]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.dates.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.entries), 'max_size': self.max_size}
+
+
+_cache = None
+
+
+def enable(max_size=10000):
+    """
+    Enables the as_of() cache, replacing any previous one.
+    """
+    global _cache
+    _cache = AsOfCache(max_size=max_size)
+    return _cache
+
+
+def disable():
+    global _cache
+    _cache = None
+
+
+def get_cache():
+    """
+    Returns the enabled AsOfCache, or None.
+    """
+    return _cache
+
+
+def stats():
+    cache = _cache
+    return cache.stats() if cache is not None else None
+
+
+def invalidate_records(records):
+    """
+    Drops the entries that the given historical records may change.
+    """
+    cache = _cache
+    if cache is None:
+        return
+    for record in records:
+        pk = getattr(record, record.instance_type._meta.pk.attname)
+        model = record.history_partition_of or record.__class__
+        cache.invalidate(model, pk, record.history_date)
+
+
+def invalidate_model(model, date):
+    """
+    Drops the entries of every object of the history `model` for dates on
+    or after `date`.
+    """
+    cache = _cache
+    if cache is not None:
+        cache.invalidate_model(model, date)
@@ -0,0 +1,91 @@
+"""
+Hooks into the commits and rollbacks of a database connection, which
+Django doesn't provide signals for.
+
+The first call to get_hooks() for a connection wraps its commit(),
+rollback(), savepoint_rollback() and close() methods, so that listeners
+added with add_commit_listener() are called after every commit, and
+listeners added with add_rollback_listener() are told which savepoint was
+rolled back (or None, for the whole transaction). Records buffered while
+a savepoint was active, see savepoint_ids(), are dropped that way when it
+rolls back.
+"""
+from django.db import transaction
+
+
+class ConnectionHooks(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.commit_listeners = []
+        self.rollback_listeners = []
+        self._commit = connection.commit
+        self._rollback = connection.rollback
+        self._savepoint_rollback = connection.savepoint_rollback
+        self._close = connection.close
+        connection.commit = self.commit
+        connection.rollback = self.rollback
+        connection.savepoint_rollback = self.savepoint_rollback
+        connection.close = self.close
+
+    def commit(self):
+        self._commit()
+        for listener in list(self.commit_listeners):
+            listener()
+
+    def rollback(self):
+        self._rollback()
+        self.rolled_back(None)
+
+    def savepoint_rollback(self, sid):
+        self._savepoint_rollback(sid)
+        self.rolled_back(sid)
+
+    def close(self):
+        # The database rolls back whatever wasn't committed.
+        self._close()
+        self.rolled_back(None)
+
+    def rolled_back(self, sid):
+        for listener in list(self.rollback_listeners):
+            listener(sid)
+
+
+def get_hooks(using=None):
+    """
+    Returns the ConnectionHooks of the connection `using`, installing them
+    if needed.
+    """
+    connection = transaction.get_connection(using)
+    hooks = connection.__dict__.get('_history_hooks')
+    if hooks is None:
+        hooks = connection.__dict__['_history_hooks'] = ConnectionHooks(connection)
+    return hooks
+
+
+def add_commit_listener(listener, using=None):
+    get_hooks(using).commit_listeners.append(listener)
+
+
+def remove_commit_listener(listener, using=None):
+    listeners = get_hooks(using).commit_listeners
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+def add_rollback_listener(listener, using=None):
+    get_hooks(using).rollback_listeners.append(listener)
+
+
+def remove_rollback_listener(listener, using=None):
+    listeners = get_hooks(using).rollback_listeners
+    if listener in listeners:
+        listeners.remove(listener)
+
+
+def savepoint_ids(using=None):
+    """
+    Returns the savepoints active on the connection `using`, which are
+    rolled back along with anything written while they were active.
+    """
+    return tuple(sid for sid in transaction.get_connection(using).savepoint_ids
+                 if sid is not None)
@@ -0,0 +1,138 @@
+"""
+Streaming export of historical records, e.g. for compliance change logs.
+
+    from simple_history import export
+    with open('polls.ndjson', 'w') as stream:
+        export.write_ndjson(Poll, stream, since=start, until=end)
+
+Records are read in `history_id` order with keyset pagination, `chunk_size`
+rows per query, so memory use doesn't grow with the table. An export can
+be resumed after the `history_id` of the last record it wrote.
+"""
+import csv
+import datetime
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils.encoding import smart_str
+
+FORMATS = ('ndjson', 'csv')
+
+
+class HistoryJSONEncoder(DjangoJSONEncoder):
+    """
+    Writes datetimes and times with isoformat(). DjangoJSONEncoder cuts
+    them down to milliseconds, which loses the order of records saved
+    within the same millisecond.
+    """
+    def default(self, o):
+        if isinstance(o, (datetime.datetime, datetime.time)):
+            return o.isoformat()
+        return super(HistoryJSONEncoder, self).default(o)
+
+
+def get_history_model(model):
+    return getattr(model, model._meta.simple_history_manager_attribute).model
+
+
+def get_columns(model):
+    """
+    Returns the names of the values of the records exported for `model`.
+    """
+    return [field.attname for field in get_history_model(model)._meta.concrete_fields]
+
+
+def parse_after(after):
+    """
+    Splits a resume position into (partition key, history_id). Records of
+    partition tables are identified as 'partition-history_id', like in the
+    admin.
+    """
+    if after is None:
+        return None, None
+    after = str(after)
+    if '-' in after:
+        key, history_id = after.split('-', 1)
+        return key, int(history_id)
+    return None, int(after)
+
+
+def export_history(model, since=None, until=None, pks=None, after=None, chunk_size=1000):
+    """
+    Yields the historical records of `model` as tuples of the values named
+    by get_columns(), in `history_id` order (partition by partition, oldest
+    first, for partitioned models).
+
+    since, until -- only records dated since (included) / until (excluded)
+    pks -- only the records of the objects with these primary keys
+    after -- only the records after this `history_id`, to resume an export
+    """
+    history = getattr(model, model._meta.simple_history_manager_attribute)
+    columns = get_columns(model)
+    id_index = columns.index('history_id')
+    after_key, after_id = parse_after(after)
+    # Oldest table first: the unpartitioned one, then the partitions.
+    for qs in reversed(history.partition_querysets(until)):
+        key = qs.model.history_partition_key
+        if after_key is not None and (key is None or key < after_key):
+            continue
+        if since is not None:
+            qs = qs.filter(history_date__gte=since)
+        if until is not None:
+            qs = qs.filter(history_date__lt=until)
+        if pks is not None:
+            qs = qs.filter(**{model._meta.pk.attname + '__in': list(pks)})
+        last_id = after_id if key == after_key else None
+        qs = qs.order_by('history_id').values_list(*columns)
+        while True:
+            chunk = qs
+            if last_id is not None:
+                chunk = chunk.filter(history_id__gt=last_id)
+            chunk = list(chunk[:chunk_size])
+            for row in chunk:
+                if key is not None:
+                    row = list(row)
+                    row[id_index] = '%s-%s' % (key, row[id_index])
+                yield row
+            if len(chunk) < chunk_size:
+                break
+            last_id = chunk[-1][id_index]
+
+
+def write_ndjson(model, stream, label=None, **filters):
+    """
+    Writes the records of `model` to `stream` as one JSON object per line.
+    `label` is added to every object as "model" if given. The filters are
+    those of export_history(). Returns the number of records written and
+    the `history_id` of the last one.
+    """
+    columns = get_columns(model)
+    id_index = columns.index('history_id')
+    encode = HistoryJSONEncoder().encode
+    keys = [encode(column) for column in columns]
+    prefix = '{"model": %s, ' % encode(label) if label else '{'
+    count, last_id = 0, None
+    for row in export_history(model, **filters):
+        stream.write('%s%s}\n' % (prefix, ', '.join(
+            '%s: %s' % (key, encode(value)) for key, value in zip(keys, row))))
+        count += 1
+        last_id = row[id_index]
+    return count, last_id
+
+
+def write_csv(model, stream, header=True, **filters):
+    """
+    Writes the records of `model` to `stream` as CSV, with a header row
+    unless `header` is False (e.g. when resuming). The filters are those
+    of export_history(). Returns the number of records written and the
+    `history_id` of the last one.
+    """
+    columns = get_columns(model)
+    id_index = columns.index('history_id')
+    writer = csv.writer(stream)
+    if header:
+        writer.writerow(columns)
+    count, last_id = 0, None
+    for row in export_history(model, **filters):
+        writer.writerow([smart_str(value) if value is not None else '' for value in row])
+        count += 1
+        last_id = row[id_index]
+    return count, last_id
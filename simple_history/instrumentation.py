@@ -0,0 +1,159 @@
+"""
+Instrumentation of history capture and time travel queries.
+
+Listeners are called with a HistoryEvent after every instrumented call:
+the signal handlers and create_historical_record() of HistoricalRecords,
+and as_of(), most_recent() and as_of_related() of HistoryManager.
+
+    from simple_history import instrumentation
+    aggregator = instrumentation.Aggregator()
+    instrumentation.add_listener(aggregator)
+    ...
+    aggregator.summary()
+
+Every event holds the time spent, the number of queries run (on every
+database) and the number of historical records written, or of objects
+returned by reads. Events of calls made from another instrumented call,
+like create_historical_record() from post_save, are marked as nested.
+
+Instrumented calls only check whether there are listeners unless one is
+registered. See middleware.HistoryInstrumentationMiddleware for a
+summary per request.
+"""
+import threading
+import timeit
+from collections import namedtuple
+from functools import wraps
+from django.conf import settings
+from django.db import connections
+
+HistoryEvent = namedtuple('HistoryEvent', 'name model duration queries rows nested')
+
+listeners = []
+_state = threading.local()
+
+
+def add_listener(callback):
+    """
+    Registers `callback` to be called with every HistoryEvent.
+    """
+    if callback not in listeners:
+        listeners.append(callback)
+
+
+def remove_listener(callback):
+    if callback in listeners:
+        listeners.remove(callback)
+
+
+def instrumented(name, get_model, reads=False):
+    """
+    Decorates a method to emit a `name` event, with the original model
+    returned by `get_model(self)`. For `reads`, the event counts one row
+    when the method returns.
+    """
+    def decorator(func):
+        @wraps(func)
+        def inner(self, *args, **kwargs):
+            if not listeners:
+                return func(self, *args, **kwargs)
+            return measure(name, get_model(self), reads, func, (self,) + args, kwargs)
+        return inner
+    return decorator
+
+
+def add_rows(count):
+    """
+    Adds `count` written records to the instrumented calls in progress.
+    """
+    for frame in getattr(_state, 'stack', ()):
+        frame[0] += count
+
+
+def measure(name, model, reads, func, args, kwargs):
+    if not hasattr(_state, 'stack'):
+        _state.stack = []
+    frame = [0]
+    nested = bool(_state.stack)
+    counters = start_counting_queries()
+    _state.stack.append(frame)
+    start = timeit.default_timer()
+    try:
+        result = func(*args, **kwargs)
+        if reads:
+            frame[0] += 1
+        return result
+    finally:
+        duration = timeit.default_timer() - start
+        _state.stack.pop()
+        event = HistoryEvent(name, model, duration, stop_counting_queries(counters),
+                             frame[0], nested)
+        for listener in list(listeners):
+            listener(event)
+
+
+def start_counting_queries():
+    """
+    Makes every connection log its queries, returning what's needed to
+    count them and to restore the connections afterwards.
+    """
+    counters = []
+    for connection in connections.all():
+        counters.append((connection, connection.use_debug_cursor, len(connection.queries)))
+        connection.use_debug_cursor = True
+    return counters
+
+
+def stop_counting_queries(counters):
+    count = 0
+    for connection, use_debug_cursor, logged in counters:
+        count += len(connection.queries) - logged
+        if not (use_debug_cursor or (use_debug_cursor is None and settings.DEBUG)):
+            # The queries wouldn't have been logged otherwise.
+            del connection.queries[logged:]
+        connection.use_debug_cursor = use_debug_cursor
+    return count
+
+
+class Aggregator(object):
+    """
+    A listener keeping the number of calls, the time spent, the queries
+    run and the rows written or read per event name and model.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def __call__(self, event):
+        key = (event.name, '%s.%s' % (event.model._meta.app_label,
+                                      event.model._meta.object_name))
+        with self.lock:
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = {'calls': 0, 'time': 0.0, 'max_time': 0.0,
+                                           'queries': 0, 'rows': 0}
+            stats['calls'] += 1
+            stats['time'] += event.duration
+            stats['max_time'] = max(stats['max_time'], event.duration)
+            stats['queries'] += event.queries
+            stats['rows'] += event.rows
+            if not event.nested:
+                # Nested calls are already part of these totals.
+                self.total['calls'] += 1
+                self.total['time'] += event.duration
+                self.total['queries'] += event.queries
+                self.total['rows'] += event.rows
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.total = {'calls': 0, 'time': 0.0, 'queries': 0, 'rows': 0}
+
+    def summary(self):
+        """
+        Returns the totals of the calls that weren't nested, and the stats
+        per (event name, 'app_label.ModelName').
+        """
+        with self.lock:
+            return {'total': dict(self.total),
+                    'events': dict((key, dict(stats)) for key, stats in self.stats.items())}
@@ -0,0 +1,66 @@
+import datetime
+import sys
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from simple_history import export
+from simple_history.management.commands.prune_history import get_history_models
+
+
+def parse_date(value):
+    for format in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, format)
+        except ValueError:
+            pass
+    raise CommandError("Invalid date '%s', use YYYY-MM-DD[THH:MM:SS]." % value)
+
+
+class Command(BaseCommand):
+    args = '[app_label[.ModelName] ...]'
+    help = ("Streams historical records to NDJSON or CSV, in history_id order, "
+            "with constant memory use.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='ndjson', choices=export.FORMATS,
+                    help='Output format: ndjson (default) or csv.'),
+        make_option('--output', '-o', dest='output',
+                    help='File to write to (default: standard output).'),
+        make_option('--since', dest='since',
+                    help='Only records dated since this date (included).'),
+        make_option('--until', dest='until',
+                    help='Only records dated until this date (excluded).'),
+        make_option('--pk', dest='pks', action='append',
+                    help='Only the records of the object with this primary key. '
+                         'Can be repeated.'),
+        make_option('--after-id', dest='after',
+                    help='Resume after this history_id (one model only).'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=1000,
+                    help='Records read per query (default: 1000).'),
+    )
+
+    def handle(self, *labels, **options):
+        models = get_history_models(labels)
+        if len(models) != 1 and (options['format'] == 'csv' or options['after']):
+            raise CommandError('CSV exports and --after-id need exactly one model.')
+        filters = {
+            'since': options['since'] and parse_date(options['since']),
+            'until': options['until'] and parse_date(options['until']),
+            'pks': options['pks'],
+            'after': options['after'],
+            'chunk_size': options['chunk_size'],
+        }
+        stream = open(options['output'], 'ab' if options['after'] else 'wb') \
+            if options['output'] else self.stdout
+        try:
+            for model in models:
+                if options['format'] == 'csv':
+                    count, last_id = export.write_csv(
+                        model, stream, header=not options['after'], **filters)
+                else:
+                    label = len(models) > 1 and '%s.%s' % (
+                        model._meta.app_label, model._meta.object_name) or None
+                    count, last_id = export.write_ndjson(model, stream, label=label, **filters)
+                sys.stderr.write('%s.%s: %d records exported, last history_id: %s\n' % (
+                    model._meta.app_label, model._meta.object_name, count, last_id))
+        finally:
+            if options['output']:
+                stream.close()
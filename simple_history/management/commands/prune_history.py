@@ -0,0 +1,59 @@
+import datetime
+import time
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django.db import models
+
+
+def get_history_models(labels):
+    """
+    Returns the SimpleHistory-managed models named by `labels`
+    (app_label or app_label.ModelName), or all of them.
+    """
+    tracked = [model for model in models.get_models(include_auto_created=True)
+               if getattr(model._meta, 'simple_history_manager_attribute', None)]
+    if not labels:
+        return tracked
+    selected = []
+    for label in labels:
+        app_label, _, model_name = label.partition('.')
+        matches = [model for model in tracked
+                   if model._meta.app_label == app_label and
+                   (not model_name or model._meta.object_name.lower() == model_name.lower())]
+        if not matches:
+            raise CommandError("No model with history matches '%s'." % label)
+        selected.extend(match for match in matches if match not in selected)
+    return selected
+
+
+class Command(BaseCommand):
+    args = '[app_label[.ModelName] ...]'
+    help = ("Deletes historical records older than each model's retention, "
+            "keeping the latest record of every object before the cutoff.")
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int', dest='days',
+                    help='Retention in days, overriding the models\' retention.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Records deleted per query (default: 1000).'),
+        make_option('--sleep', type='float', dest='sleep', default=0,
+                    help='Seconds to wait between batches (default: 0).'),
+    )
+
+    def handle(self, *labels, **options):
+        now = datetime.datetime.now()
+        for model in get_history_models(labels):
+            history = getattr(model, model._meta.simple_history_manager_attribute)
+            if options['days'] is not None:
+                retention = datetime.timedelta(days=options['days'])
+            else:
+                retention = history.model.history_retention
+            if retention is None:
+                continue
+            start = time.time()
+            deleted = history.prune(now - retention,
+                                    batch_size=options['batch_size'],
+                                    sleep=options['sleep'])
+            elapsed = time.time() - start
+            self.stdout.write('%s.%s: %d records deleted in %.1fs (%.0f records/s)' % (
+                model._meta.app_label, model._meta.object_name, deleted, elapsed,
+                deleted / elapsed if elapsed else 0))
@@ -1,4 +1,15 @@
-from django.db import models
+import heapq
+import itertools
+import operator
+import re
+import time
+from collections import defaultdict, namedtuple
+from django.db import connections, models, router, transaction
+from instrumentation import instrumented
+import cache
+
+def original_model(manager):
+    return manager.model.instance_type
 
 class HistoryDescriptor(object):
     def __init__(self, model):
@@ -9,22 +20,257 @@ class HistoryDescriptor(object):
             return HistoryManager(self.model)
         return HistoryManager(self.model, instance)
 
+def rebuild_values(rows, fields):
+    """
+    Folds historical records, given as dicts newest first, into the field
+    values of the newest one. Delta records list the fields they store in
+    `history_delta_fields`; folding stops at the first full record.
+
+    Returns a dictionary of values and the number of records used.
+    """
+    values = {}
+    count = 0
+    for row in rows:
+        count += 1
+        stored = row.get('history_delta_fields')
+        if stored is None:
+            names = fields
+        else:
+            names = stored.split(',') if stored else []
+        for name in names:
+            if name not in values:
+                values[name] = row[name]
+        if stored is None:
+            break
+    return values, count
+
+class FieldPlan(object):
+    """
+    Describes, once per history model, how the tracked fields of the
+    original `model` map to historical records and back, so that saving
+    and reading history doesn't walk `_meta.fields` every time.
+    """
+    def __init__(self, model, tracked):
+        self.model = model
+        self.tracked = tuple(tracked)
+        if len(self.tracked) == 1:
+            name = self.tracked[0]
+            self.get_values = lambda obj: (getattr(obj, name),)
+        else:
+            self.get_values = operator.attrgetter(*self.tracked)
+        attnames = tuple(field.attname for field in model._meta.fields)
+        self.complete = attnames == self.tracked
+        # For every field of the original model, either the position of
+        # its value among the tracked values, or the field itself so its
+        # default can be used.
+        positions = dict((name, i) for i, name in enumerate(self.tracked))
+        self.layout = tuple(positions.get(field.attname, field)
+                            for field in model._meta.fields)
+
+    def build(self, values):
+        """
+        Creates an instance of the original model from the tracked
+        `values`. Fields that aren't tracked get their default value.
+        """
+        if self.complete:
+            return self.model(*values)
+        return self.model(*[values[item] if isinstance(item, int)
+                            else item.get_default()
+                            for item in self.layout])
+
+class HistoricalQuerySet(models.query.QuerySet):
+    # The date the records are the latest of their objects as of, if they
+    # are, see HistoryManager._latest_as_of().
+    _latest_as_of = None
+    # Rows per query when iterating with a for loop, or None to load them
+    # all at once like any queryset, see HistoryManager.snapshot().
+    _iteration_chunk_size = None
+
+    def _clone(self, *args, **kwargs):
+        qs = super(HistoricalQuerySet, self)._clone(*args, **kwargs)
+        qs._latest_as_of = self._latest_as_of
+        qs._iteration_chunk_size = self._iteration_chunk_size
+        return qs
+
+    def __iter__(self):
+        if (self._iteration_chunk_size is None or self._result_cache is not None
+                or not self.query.can_filter()):
+            return super(HistoricalQuerySet, self).__iter__()
+        return self.chunked(self._iteration_chunk_size)
+
+    def iterator(self, chunk_size=500):
+        """
+        Completes the delta records of models storing deltas, when the
+        records are the latest ones as of a date, with one query per
+        `chunk_size` records. See complete_deltas().
+        """
+        records = super(HistoricalQuerySet, self).iterator()
+        if (self._latest_as_of is None or
+                not getattr(self.model, 'history_checkpoint_every', None)):
+            for record in records:
+                yield record
+            return
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                return
+            self.complete_deltas(chunk)
+            for record in chunk:
+                yield record
+
+    def complete_deltas(self, records):
+        """
+        Rebuilds the values of the delta records among `records`, the latest
+        records of their objects as of `_latest_as_of`, from the records of
+        those objects back to their latest full record, read with one query.
+        The values are kept as `_history_values` for history_object.
+        """
+        records = [record for record in records if record.history_delta_fields is not None]
+        if not records:
+            return
+        plan = self.model.history_field_plan
+        pk_name = plan.model._meta.pk.attname
+        opts = self.model._meta
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        pk_column = qn(opts.get_field(pk_name).column)
+        date = opts.get_field('history_date').get_db_prep_value(self._latest_as_of, connection)
+        where = ('%(table)s.history_date >= ('
+                 'SELECT MAX(checkpoint.history_date) FROM %(table)s checkpoint'
+                 ' WHERE checkpoint.%(pk)s = %(table)s.%(pk)s'
+                 ' AND checkpoint.history_delta_fields IS NULL'
+                 ' AND checkpoint.history_date <= %%s)' % {'table': table, 'pk': pk_column})
+        rows = (self.model._default_manager.using(self.db)
+                .filter(history_date__lte=self._latest_as_of,
+                        **{pk_name + '__in': set(getattr(record, pk_name) for record in records)})
+                .extra(where=[where], params=[date])
+                .order_by(pk_name, '-history_date', '-history_id')
+                .values('history_id', 'history_delta_fields', *plan.tracked))
+        by_object = defaultdict(list)
+        for row in rows:
+            by_object[row[pk_name]].append(row)
+        for record in records:
+            rows = by_object[getattr(record, pk_name)]
+            ids = [row['history_id'] for row in rows]
+            if record.history_id not in ids:
+                continue
+            values, count = rebuild_values(rows[ids.index(record.history_id):], plan.tracked)
+            if len(values) == len(plan.tracked):
+                record._history_values = tuple(values[name] for name in plan.tracked)
+
+    def latest_values(self, fields):
+        """
+        Returns the history type and the values of `fields` of the first
+        record in the queryset. For models storing deltas (see the
+        `checkpoint_every` option of HistoricalRecords) the values are
+        rebuilt from the nearest full record.
+        Raises IndexError if the queryset is empty.
+        """
+        checkpoint_every = getattr(self.model, 'history_checkpoint_every', None)
+        if not checkpoint_every:
+            values = self.values_list('history_type', *fields)[0]
+            return values[0], values[1:]
+        rows = list(self.values('history_type', 'history_delta_fields',
+                                *fields)[:checkpoint_every])
+        values, count = rebuild_values(rows, fields)
+        return rows[0]['history_type'], tuple(values.get(name) for name in fields)
+
+    def chunked(self, chunk_size=1000):
+        """
+        Iterates over the historical records in `history_id` order, fetching
+        `chunk_size` rows per query with keyset pagination, so memory use
+        stays flat no matter how many rows match.
+        """
+        qs = self.order_by('history_id')
+        qs._iteration_chunk_size = None
+        last_id = None
+        while True:
+            chunk = qs
+            if last_id is not None:
+                chunk = chunk.filter(history_id__gt=last_id)
+            chunk = list(chunk[:chunk_size])
+            for record in chunk:
+                yield record
+            if len(chunk) < chunk_size:
+                return
+            last_id = chunk[-1].history_id
+
+    def estimated_count(self):
+        """
+        Returns the number of records the database's query planner expects
+        the queryset to match, which unlike count() doesn't read the
+        matching index entries. Falls back to count() on databases that
+        can't estimate it.
+        """
+        connection = connections[self.db]
+        if connection.vendor not in ('postgresql', 'mysql'):
+            return self.count()
+        qs = self.order_by().values_list('history_id')
+        sql, params = qs.query.get_compiler(self.db).as_sql()
+        cursor = connection.cursor()
+        cursor.execute('EXPLAIN ' + sql, params)
+        if connection.vendor == 'mysql':
+            columns = [column[0] for column in cursor.description]
+            return int(cursor.fetchone()[columns.index('rows')] or 0)
+        match = re.search(r'rows=(\d+)', cursor.fetchone()[0])
+        return int(match.group(1)) if match else self.count()
+
+HistoricalDiff = namedtuple('HistoricalDiff', 'pk history_id history_date history_type '
+                                             'changed_by_id changes')
+
+def values_by_object(queryset, fields, chunk_size=1000):
+    """
+    Iterates over the historical records of `queryset` in (pk,
+    history_date, history_id) order, yielding tuples of those three values
+    followed by the values of `fields`. Rows are fetched `chunk_size` at a
+    time with keyset pagination, which reads them straight from the
+    (pk, history_date, history_id) index.
+    """
+    pk_name = queryset.model.instance_type._meta.pk.attname
+    qs = queryset.order_by(pk_name, 'history_date', 'history_id').values_list(
+        pk_name, 'history_date', 'history_id', *fields)
+    last = None
+    while True:
+        chunk = qs
+        if last is not None:
+            pk, date, history_id = last
+            chunk = chunk.filter(
+                models.Q(**{pk_name + '__gt': pk}) |
+                models.Q(**{pk_name: pk, 'history_date__gt': date}) |
+                models.Q(**{pk_name: pk, 'history_date': date, 'history_id__gt': history_id}))
+        chunk = list(chunk[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1][:3]
+
+def get_history_db(model):
+    """
+    Returns the database alias historical records of `model` are written to.
+    """
+    return getattr(model, 'history_using', None) or router.db_for_write(model)
+
 class HistoryManager(models.Manager):
-    def __init__(self, model, instance=None):
+    def __init__(self, model=None, instance=None):
         super(HistoryManager, self).__init__()
         self.model = model
         self.instance = instance
 
     def get_queryset(self):
+        using = self._db or getattr(self.model, 'history_using', None)
+        qs = HistoricalQuerySet(self.model, using=using)
         if self.instance is None:
-            return super(HistoryManager, self).get_queryset()
+            return qs
 
         if isinstance(self.instance._meta.pk, models.OneToOneField):
             filter = {self.instance._meta.pk.name + "_id":self.instance.pk}
         else:
             filter = {self.instance._meta.pk.name: self.instance.pk}
-        return super(HistoryManager, self).get_queryset().filter(**filter)
+        return qs.filter(**filter)
 
+    @instrumented('most_recent', original_model, reads=True)
     def most_recent(self):
         """
         Returns the most recent copy of the instance available in the history.
@@ -32,20 +278,15 @@ class HistoryManager(models.Manager):
         if not self.instance:
             raise TypeError("Can't use most_recent() without a %s instance." % \
                             self.instance._meta.object_name)
-        tmp = []
-        for field in self.instance._meta.fields:
-            if isinstance(field, models.ForeignKey):
-                tmp.append(field.name + "_id")
-            else:
-                tmp.append(field.name)
-        fields = tuple(tmp)
-        try:
-            values = self.values_list(*fields)[0]
-        except IndexError:
+        plan = self.model.history_field_plan
+        latest = self._latest_values()
+        if latest is None:
             raise self.instance.DoesNotExist("%s has no historical record." % \
                                              self.instance._meta.object_name)
-        return self.instance.__class__(*values)
+        history_type, values = latest
+        return plan.build(values)
 
+    @instrumented('as_of', original_model, reads=True)
     def as_of(self, date):
         """
         Returns an instance of the original model with all the attributes set
@@ -54,24 +295,70 @@ class HistoryManager(models.Manager):
         if not self.instance:
             raise TypeError("Can't use as_of() without a %s instance." % \
                             self.instance._meta.object_name)
-        tmp = []
-        for field in self.instance._meta.fields:
-            if isinstance(field, models.ForeignKey):
-                tmp.append(field.name + "_id")
-            else:
-                tmp.append(field.name)
-        fields = tuple(tmp)
-        qs = self.filter(history_date__lte=date)
+        plan = self.model.history_field_plan
+        as_of_cache = cache.get_cache()
         try:
-            values = qs.values_list('history_type', *fields)[0]
-        except IndexError:
+            if as_of_cache is None:
+                raise KeyError
+            latest = as_of_cache.get(self.model, self.instance.pk, date)
+        except KeyError:
+            latest = self._latest_values(date)
+            # What a transaction reads may be rolled back.
+            if (as_of_cache is not None and
+                    not transaction.get_connection(self.db).in_atomic_block):
+                as_of_cache.set(self.model, self.instance.pk, date, latest)
+        if latest is None:
             raise self.instance.DoesNotExist("%s had not yet been created." % \
                                              self.instance._meta.object_name)
-        if values[0] == '-':
+        history_type, values = latest
+        if history_type == '-':
             raise self.instance.DoesNotExist("%s had already been deleted." % \
                                              self.instance._meta.object_name)
-        return self.instance.__class__(*values[1:])
+        return plan.build(values)
+
+    def _latest_values(self, until=None):
+        """
+        Returns the history type and tracked values of the latest record
+        dated up to `until` (or the latest record at all), or None. Only the
+        partitions that can hold such a record are searched.
+        """
+        for qs in self.partition_querysets(until):
+            if until is not None:
+                qs = qs.filter(history_date__lte=until)
+            try:
+                return qs.latest_values(self.model.history_field_plan.tracked)
+            except IndexError:
+                pass
+        return None
+
+    def partition_querysets(self, until=None):
+        """
+        Returns one queryset per table holding records dated up to `until`,
+        newest first. That's just get_queryset() unless the historical model
+        is partitioned, see partitions.PartitionSet.
+        """
+        partitions = self.model.history_partitions
+        if partitions is None:
+            return [self.get_queryset()]
+        return [HistoryManager(model, self.instance).get_queryset()
+                for model in partitions.models_until(until)]
+
+    def all_partitions(self, until=None):
+        """
+        Returns the records of every table holding records dated up to
+        `until`, as a PartitionedRecords. Unlike get_queryset(), which only
+        reads the historical model's own table, this includes the partitions
+        of partitioned models.
+        """
+        return PartitionedRecords(self.partition_querysets(until))
+
+    def create_partition(self, date):
+        """
+        Creates the partition table for records dated `date`, if needed.
+        """
+        return self.model.history_partitions.model_for_date(date)
 
+    @instrumented('as_of_related', original_model, reads=True)
     def as_of_related(self, history_date):
         """
         Returns an instance of the original model with all the attributes set
@@ -79,86 +366,617 @@ class HistoryManager(models.Manager):
         all FK relations to SimpleHistory-managed models will also be retrieved
         with their historical versions at the provided date.
         """
-        def inject_acessor(instance):
-            base_class = instance.__class__
-            
-            fk_fields = []
-            attributes = []
-            m2m_fields = getattr(base_class, 'm2m_history_fields', [])
-            for field in instance._meta.fields:
-                if isinstance(field, models.ForeignKey):
-                    fk_fields.append(field.name)
-                attr = (field.name, getattr(instance, field.name))
-                attributes.append(attr)
-
-            new_base = (base_class,)
-            new_name = '%s_as_of_%s_managed' % (base_class.__name__, history_date.strftime("%Y%m%d%H%M%S"))
-            #new_name = base_class.__name__
-
-            def getattribute(attr_instance, name):
-                overridden_fields = fk_fields
-                #if name == 'simple_history_overridden_fields' or name == '__dict__':
-                #    return super(attr_instance.__class__, attr_instance).__getattribute__(name)
-                if name in overridden_fields:
-                    # value = super(attr_instance.__class__, attr_instance).__getattribute__(name)
-                    value = base_class.__getattribute__(attr_instance, name)
-                    if hasattr(value, 'simple_history_manager') and not hasattr(value, 'as_of_retrieved'):
-                        manager = getattr(value, value.simple_history_manager)
-                        value = manager.as_of(history_date)
-                    if value and not hasattr(value, 'as_of_managed'):
-                        value = inject_acessor(value)
-                    setattr(value, 'as_of_retrieved', True)
-                    return value
-                elif name in m2m_fields:
-                    # Next six lines based on: http://djangosnippets.org/snippets/236/
-                    from django.db.models.sql.compiler import SQLCompiler
-                    sql_patched = getattr(SQLCompiler, 'quote_name_unless_alias_patched', False)
-                    if not sql_patched:
-                        _quote_name_unless_alias = SQLCompiler.quote_name_unless_alias
-                        SQLCompiler.quote_name_unless_alias_patched = True
-                        SQLCompiler.quote_name_unless_alias = lambda self, name: name if name.startswith('(') else _quote_name_unless_alias(self, name)
-
-                    m2m_class = base_class.__dict__[name].through
-                    source_field_name, target_field_name = None, None
-                    for field_name, field_value in m2m_class.__dict__.items():
-                        if isinstance(field_value, models.fields.related.ReverseSingleRelatedObjectDescriptor):
-                            if field_value.field.related.parent_model == instance.__class__:
-                                source_field_name = field_name
-                            else:
-                                target_field_name = field_name
-
-                    db_table = m2m_class.history.model._meta.db_table
-                    table = '(select max(history_id) as max_id from %s inner_hm2m'\
-                            ' where history_date <= "%s" and %s_id=%s'\
-                            ' group by id'\
-                            ' order by history_date desc, history_id desc) as top_ids'\
-                             % (db_table, history_date.strftime('%Y-%m-%d %H:%M:%S'), source_field_name, instance.pk)
-                    conditions = ['top_ids.max_id = %s.history_id' % db_table,
-                                  'history_type = "+"']
-                    historical_items = m2m_class.history.get_queryset().extra(where=conditions, tables=[table])
-                    m2m_item_ids = historical_items.values_list(target_field_name + '_id', flat=True)
-                    target_model = base_class.__dict__[name].field.rel.to
-                    items = target_model.objects.filter(pk__in=list(m2m_item_ids))
-                    return items
-                    # TODO: items retrieved through this queryset should also be injected.
-                    # Known issue: this will only retrieve target items that haven't been deleted. 
-                
-                else:
-                    #raise AttributeError()
-                    return base_class.__getattribute__(attr_instance, name)
-
-            new_dict = {'__getattribute__': getattribute,
-                        'as_of_related': True,
-                        #'simple_history_overridden_fields': fk_fields,
-                        '__module__': instance.__module__,
-                        }
-            new_class = type(new_name, new_base, new_dict)
-            #new_class._meta.db_table = base_class._meta.db_table
-            new_class._meta.proxy = True
-
-            new_kwargs = dict(attributes);
-            return new_class(**new_kwargs)
-
-        historical_instance = self.as_of(history_date)
-        return inject_acessor(historical_instance)
+        return as_of_related_instance(self.as_of(history_date), history_date)
+
+    def as_of_related_many(self, date, pks=None, chunk_size=500):
+        """
+        Like as_of_many(), but yields as_of_related() instances whose
+        historical FK targets are fetched with one query per related model
+        and chunk, see prefetch_as_of_related().
+        """
+        instances = self.as_of_many(date, pks=pks, chunk_size=chunk_size)
+        while True:
+            chunk = [as_of_related_instance(instance, date)
+                     for instance in itertools.islice(instances, chunk_size)]
+            if not chunk:
+                return
+            prefetch_as_of_related(chunk)
+            for instance in chunk:
+                yield instance
+
+    def as_of_many(self, date, pks=None, chunk_size=500):
+        """
+        Yields an instance of the original model for every object that
+        existed on the date provided, with its attributes set as they were
+        on that date. Objects deleted by then are skipped.
+
+        `pks` restricts the lookup to the given primary keys. The latest
+        record of each object is resolved in the database, with one query
+        per `chunk_size` primary keys.
+        """
+        model = self.model.instance_type
+        qs = self.snapshot(date)
+        if pks is None:
+            records = qs.chunked(chunk_size)
+        else:
+            pks = list(pks)
+            pk_name = model._meta.pk.attname
+            if self.model.history_partitions is not None:
+                records = (record for i in range(0, len(pks), chunk_size)
+                           for record in qs.for_pks(pks[i:i + chunk_size]))
+            else:
+                records = (record for i in range(0, len(pks), chunk_size)
+                           for record in qs.filter(**{pk_name + '__in': pks[i:i + chunk_size]}))
+        for record in records:
+            yield record.history_object
+
+    def diffs(self, queryset=None, fields=None, chunk_size=1000):
+        """
+        Yields a HistoricalDiff for every historical record, holding the
+        fields that changed since the previous record of the same object as
+        a dictionary of field names to (old, new) values. Every field of the
+        first record of an object counts as changed, with an old value of
+        None.
+
+        The records of the instance (or of every object) are read once, in
+        (pk, history_date, history_id) order, `chunk_size` rows per query.
+        Pass a `queryset` of historical records to restrict the diffs to
+        some of them, and `fields` to only compare some of the fields.
+        """
+        plan = self.model.history_field_plan
+        model = self.model.instance_type
+        pk_name = model._meta.pk.attname
+        if fields is None:
+            names = [name for name in plan.tracked if name != pk_name]
+        else:
+            names = [model._meta.get_field(name).attname for name in fields]
+        deltas = bool(getattr(self.model, 'history_checkpoint_every', None))
+        columns = ['history_type', 'changed_by_id'] + names
+        if deltas:
+            columns.append('history_delta_fields')
+        if queryset is None:
+            querysets = self.partition_querysets()
+        else:
+            querysets = [queryset]
+        # Partitions are merged back into one stream, in the same order.
+        rows = heapq.merge(*[values_by_object(qs, columns, chunk_size)
+                             for qs in querysets])
+        last_pk, values = None, {}
+        for row in rows:
+            pk, history_date, history_id, history_type, changed_by_id = row[:5]
+            if pk != last_pk:
+                last_pk, values = pk, {}
+            stored = None
+            if deltas and row[-1] is not None:
+                stored = row[-1].split(',') if row[-1] else []
+            changes = {}
+            for name, new in zip(names, row[5:]):
+                if stored is not None and name not in stored:
+                    continue
+                if name not in values or values[name] != new:
+                    changes[name] = (values.get(name), new)
+                values[name] = new
+            yield HistoricalDiff(pk, history_id, history_date, history_type,
+                                 changed_by_id, changes)
+
+    def revert_to(self, date, objects=None, changed_by=None, chunk_size=500):
+        """
+        Reverts objects to their state as of the date provided, in one
+        transaction: objects changed since are updated, objects deleted
+        since are created again and objects created since are deleted.
+        The states are resolved with as_of_many(), and the rows and their
+        historical records are written in bulk, `chunk_size` objects at a
+        time. Many-to-many relations aren't reverted.
+
+        `objects` is a queryset of the original model or a list of primary
+        keys. It defaults to the instance, or to every object with history.
+        Returns a dictionary of the primary keys of the 'created',
+        'updated' and 'deleted' objects.
+        """
+        model = self.model.instance_type
+        pk_name = model._meta.pk.attname
+        using = None
+        if isinstance(objects, models.query.QuerySet):
+            using = objects.db
+            pks = objects.values_list('pk', flat=True)
+        elif objects is not None:
+            pks = [model._meta.pk.to_python(pk) for pk in objects]
+        elif self.instance is not None:
+            pks = [self.instance.pk]
+        else:
+            pks = set()
+            for qs in self.partition_querysets():
+                pks.update(qs.values_list(pk_name, flat=True).distinct())
+        return model._meta.simple_history_records.revert_to(
+            date, list(pks), changed_by=changed_by, using=using, chunk_size=chunk_size)
+
+    def prune(self, cutoff, batch_size=1000, sleep=0):
+        """
+        Deletes the historical records dated before `cutoff`, except the
+        latest one of each object, so that as_of(cutoff) keeps working.
+        Objects deleted before `cutoff` lose all their records. Kept delta
+        records are first rewritten as full records.
+
+        Records are deleted `batch_size` at a time in `history_id` order,
+        sleeping `sleep` seconds between batches to keep locks short.
+        Partitioned historical models drop their partitions older than
+        `cutoff` instead, see PartitionSet.drop_before.
+        Returns the number of records deleted.
+        """
+        from simple_history.models import historical_values
+        pk_name = self.model.instance_type._meta.pk.attname
+        plan = self.model.history_field_plan
+        old = self.filter(history_date__lt=cutoff).order_by('history_id')
+        deleted = 0
+        if self.model.history_partitions is not None:
+            deleted += self.model.history_partitions.drop_before(cutoff)
+        last_id = 0
+        while True:
+            rows = list(old.filter(history_id__gt=last_id)
+                           .values_list('history_id', pk_name)[:batch_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            pks = set(pk for history_id, pk in rows)
+            keep = set()
+            for record in self._latest_as_of(cutoff).filter(**{pk_name + '__in': pks}):
+                if record.history_type == '-':
+                    continue
+                keep.add(record.history_id)
+                if getattr(record, 'history_delta_fields', None) is not None:
+                    values = dict(zip(plan.tracked, historical_values(record)))
+                    self.model._default_manager.filter(history_id=record.history_id).update(
+                        history_delta_fields=None, **values)
+            ids = [history_id for history_id, pk in rows if history_id not in keep]
+            if ids:
+                self.model._default_manager.filter(history_id__in=ids).delete()
+                deleted += len(ids)
+            if len(rows) < batch_size:
+                break
+            if sleep:
+                time.sleep(sleep)
+        # Cached lookups for dates before the cutoff may have changed.
+        as_of_cache = cache.get_cache()
+        if deleted and as_of_cache is not None:
+            as_of_cache.clear()
+        return deleted
+
+    def snapshot(self, date):
+        """
+        Returns a queryset with the latest historical record of every object
+        that existed on the date provided, i.e. the whole table as it was on
+        that date. Iterating over it with a for loop reads it with chunked(),
+        in `history_id` order, so memory use stays flat; len(), list() and
+        indexing still load every row.
+
+        On models storing deltas, use the records' `history_object` to get
+        their full values. Partitioned models return a PartitionedSnapshot
+        instead, which searches one partition at a time.
+        """
+        if self.model.history_partitions is not None:
+            return PartitionedSnapshot(self, date)
+        qs = self._latest_as_of(date).exclude(history_type='-')
+        qs._iteration_chunk_size = 1000
+        return qs
+
+    def _latest_as_of(self, date):
+        """
+        Returns a queryset of the latest historical record of every object
+        as of the date provided, including deletion records.
+        """
+        qs = self.get_queryset()
+        opts = self.model._meta
+        connection = connections[qs.db]
+        qn = connection.ops.quote_name
+        table = qn(opts.db_table)
+        pk_column = qn(opts.get_field(self.model.instance_type._meta.pk.attname).column)
+        db_date = opts.get_field('history_date').get_db_prep_value(date, connection)
+        where = ('%(table)s.history_id = ('
+                 'SELECT latest.history_id FROM %(table)s latest'
+                 ' WHERE latest.%(pk)s = %(table)s.%(pk)s'
+                 ' AND latest.history_date <= %%s'
+                 ' ORDER BY latest.history_date DESC, latest.history_id DESC'
+                 ' LIMIT 1)' % {'table': table, 'pk': pk_column})
+        qs = qs.extra(where=[where], params=[db_date])
+        qs._latest_as_of = date
+        return qs
+
+
+class PartitionedRecords(object):
+    """
+    The historical records of several tables, see
+    HistoryManager.all_partitions(). Supports filter(), exclude(), count(),
+    exists() and iteration, newest first, `chunk_size` rows per query.
+    """
+    chunk_size = 1000
+
+    def __init__(self, querysets):
+        self.querysets = querysets
+
+    def filter(self, *args, **kwargs):
+        return self.__class__([qs.filter(*args, **kwargs) for qs in self.querysets])
+
+    def exclude(self, *args, **kwargs):
+        return self.__class__([qs.exclude(*args, **kwargs) for qs in self.querysets])
+
+    def count(self):
+        return sum(qs.count() for qs in self.querysets)
+
+    def exists(self):
+        return any(qs.exists() for qs in self.querysets)
+
+    def __iter__(self):
+        # Partitions hold consecutive periods, newest first, so their records
+        # only need sorting within each table.
+        for qs in self.querysets:
+            qs = qs.order_by('-history_date', '-history_id')
+            last = None
+            while True:
+                chunk = qs
+                if last is not None:
+                    chunk = chunk.filter(models.Q(history_date__lt=last.history_date) |
+                                         models.Q(history_date=last.history_date,
+                                                  history_id__lt=last.history_id))
+                chunk = list(chunk[:self.chunk_size])
+                for record in chunk:
+                    yield record
+                if len(chunk) < self.chunk_size:
+                    break
+                last = chunk[-1]
+
+
+class PartitionedSnapshot(object):
+    """
+    The snapshot() of a partitioned historical model. The latest record of
+    an object is in the newest partition holding any of its records, so
+    each partition is searched with the same correlated subquery as an
+    unpartitioned snapshot, leaving out the objects with records in newer
+    partitions. Supports filter(), chunked(), for_pks() and iteration.
+    """
+    def __init__(self, manager, date, querysets=None):
+        self.manager = manager
+        self.date = date
+        self.pk_name = manager.model.instance_type._meta.pk.attname
+        if querysets is None:
+            querysets, newer = [], []
+            for qs in manager.partition_querysets(date):
+                latest = HistoryManager(qs.model, manager.instance)._latest_as_of(date)
+                for model in newer:
+                    latest = self.exclude_newer(latest, model)
+                querysets.append(latest.exclude(history_type='-'))
+                newer.append(qs.model)
+        self.querysets = querysets
+
+    def exclude_newer(self, qs, model):
+        """
+        Leaves the objects with records of `model` dated up to the snapshot
+        out of `qs`.
+        """
+        connection = connections[qs.db]
+        qn = connection.ops.quote_name
+        opts = model._meta
+        pk_column = qn(opts.get_field(self.pk_name).column)
+        date = opts.get_field('history_date').get_db_prep_value(self.date, connection)
+        where = ('NOT EXISTS (SELECT 1 FROM %(newer)s newer'
+                 ' WHERE newer.%(pk)s = %(table)s.%(pk)s AND newer.history_date <= %%s)' % {
+                     'newer': qn(opts.db_table), 'table': qn(qs.model._meta.db_table),
+                     'pk': pk_column})
+        return qs.extra(where=[where], params=[date])
+
+    def filter(self, *args, **kwargs):
+        return self.__class__(self.manager, self.date,
+                              [qs.filter(*args, **kwargs) for qs in self.querysets])
+
+    def chunked(self, chunk_size=1000):
+        """
+        Iterates over the records partition by partition, `chunk_size` rows
+        per query, see HistoricalQuerySet.chunked().
+        """
+        for qs in self.querysets:
+            for record in qs.chunked(chunk_size):
+                yield record
+
+    def for_pks(self, pks):
+        """
+        Yields the records of the objects with primary keys `pks`, with one
+        query per partition, until every object has been found.
+        """
+        pks = list(pks)
+        for qs in self.querysets:
+            if not pks:
+                return
+            records = list(qs.filter(**{self.pk_name + '__in': pks}))
+            found = set(getattr(record, self.pk_name) for record in records)
+            pks = [pk for pk in pks if pk not in found]
+            for record in records:
+                yield record
+
+    def __iter__(self):
+        return self.chunked()
+
+
+class HistoryAwareQuerySetMixin(object):
+    """
+    Records history for the bulk operations that don't send signals:
+    `bulk_create()` writes the '+' records with one bulk INSERT and
+    `update()` copies the updated rows into the historical table with one
+    INSERT ... SELECT. Use `changed_by(user)` to set who made the change.
+    """
+    _history_changed_by = None
+
+    def changed_by(self, user):
+        qs = self._clone()
+        qs._history_changed_by = user
+        return qs
+
+    def _clone(self, *args, **kwargs):
+        qs = super(HistoryAwareQuerySetMixin, self)._clone(*args, **kwargs)
+        qs._history_changed_by = self._history_changed_by
+        return qs
+
+    def bulk_create(self, objs, batch_size=None):
+        """
+        Like QuerySet.bulk_create(), but also writes a historical record of
+        every object. Since the primary keys of bulk created objects aren't
+        known afterwards, they must be set beforehand.
+        """
+        records = getattr(self.model._meta, 'simple_history_records', None)
+        if records is None:
+            return super(HistoryAwareQuerySetMixin, self).bulk_create(objs, batch_size)
+        objs = list(objs)
+        if any(obj.pk is None for obj in objs):
+            raise ValueError("bulk_create() can only record the history of %s "
+                             "objects whose primary key is set." %
+                             self.model._meta.object_name)
+        with transaction.atomic(using=self.db):
+            objs = super(HistoryAwareQuerySetMixin, self).bulk_create(objs, batch_size)
+            records.create_historical_records(objs, '+', self._history_changed_by,
+                                              using=self.db)
+        return objs
+
+    def update(self, **kwargs):
+        """
+        Like QuerySet.update(), but also writes a historical record of every
+        updated row, without loading the rows.
+        """
+        records = getattr(self.model._meta, 'simple_history_records', None)
+        if records is None or not kwargs:
+            return super(HistoryAwareQuerySetMixin, self).update(**kwargs)
+        changed_by = self._history_changed_by
+        self._for_write = True
+        with transaction.atomic(using=self.db):
+            if records.can_record_update(self):
+                records.record_update(self, kwargs, changed_by)
+                return super(HistoryAwareQuerySetMixin, self).update(**kwargs)
+            # The rows have to be read back, but only once updated.
+            pks = list(self.values_list('pk', flat=True))
+            rows = super(HistoryAwareQuerySetMixin, self).update(**kwargs)
+            objects = self.model._default_manager.using(self.db)
+            for i in range(0, len(pks), 500):
+                records.create_historical_records(
+                    objects.filter(pk__in=pks[i:i + 500]), '~', changed_by, using=self.db)
+            return rows
+
+
+class HistoryAwareQuerySet(HistoryAwareQuerySetMixin, models.query.QuerySet):
+    pass
+
+
+class HistoryAwareManager(models.Manager):
+    """
+    A manager whose querysets record history for bulk_create() and
+    update(), see HistoryAwareQuerySetMixin.
+    """
+    def get_queryset(self):
+        return HistoryAwareQuerySet(self.model, using=self._db)
+
+    def changed_by(self, user):
+        return self.get_queryset().changed_by(user)
+
+
+def get_history_manager_name(model):
+    return getattr(model._meta, 'simple_history_manager_attribute', None)
+
+
+class HistoricalForeignKeyDescriptor(object):
+    """
+    Used by as_of_related() instances in place of the descriptor of a
+    ForeignKey to a SimpleHistory-managed model. Returns the related object
+    as it was on the instance's history date.
+    """
+    def __init__(self, field):
+        self.field = field
+        self.cache_name = '_history_%s_cache' % field.name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.cache_name not in instance.__dict__:
+            prefetch_as_of_related([instance], [self.field.name])
+        value = instance.__dict__[self.cache_name]
+        if value is None and getattr(instance, self.field.attname) is not None:
+            raise self.field.rel.to.DoesNotExist(
+                "%s did not exist on %s." % (self.field.rel.to._meta.object_name,
+                                             instance._history_date))
+        return value
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.cache_name] = value
+        setattr(instance, self.field.attname, value.pk if value is not None else None)
+
+
+class HistoricalRelatedList(list):
+    """
+    The related objects of a many-to-many relation of an as_of_related()
+    instance. A list, which also has the read-only part of the related
+    manager API that forms and templates use.
+    """
+    def __init__(self, model, objects=()):
+        super(HistoricalRelatedList, self).__init__(objects)
+        self.model = model
+
+    def all(self):
+        return self
+
+    def count(self):
+        return len(self)
+
+    def exists(self):
+        return bool(self)
+
+    def values_list(self, *fields, **kwargs):
+        if not fields:
+            fields = [field.attname for field in self.model._meta.concrete_fields]
+        if kwargs.get('flat'):
+            return [getattr(obj, fields[0]) for obj in self]
+        return [tuple(getattr(obj, name) for name in fields) for obj in self]
+
+
+class HistoricalManyToManyDescriptor(object):
+    """
+    Used by as_of_related() instances in place of the descriptor of a
+    ManyToManyField listed in `m2m_history_fields`. Returns a
+    HistoricalRelatedList of the related objects as they were on the
+    instance's history date, including objects that have been deleted
+    since. Assignments go through the field's own descriptor, e.g. when
+    reverting with a form.
+    """
+    def __init__(self, field, descriptor):
+        self.field = field
+        self.descriptor = descriptor
+        self.cache_name = '_history_%s_cache' % field.name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if self.cache_name not in instance.__dict__:
+            prefetch_as_of_related([instance], [self.field.name])
+        return instance.__dict__[self.cache_name]
+
+    def __set__(self, instance, value):
+        self.descriptor.__set__(instance, value)
+        instance.__dict__[self.cache_name] = HistoricalRelatedList(
+            self.field.rel.to, self.descriptor.__get__(instance, type(instance)).all())
+
+
+_as_of_related_classes = {}
+
+def as_of_related_class(model):
+    """
+    Returns the proxy class of `model` used for as_of_related() instances.
+    Classes are created once per model; the history date is kept on the
+    instances.
+    """
+    try:
+        return _as_of_related_classes[model]
+    except KeyError:
+        pass
+    attrs = {
+        '__module__': model.__module__,
+        'Meta': type('Meta', (), {'proxy': True, 'app_label': model._meta.app_label}),
+        'as_of_related': True,
+        'history_fk_fields': [],
+        'history_m2m_fields': [],
+    }
+    for field in model._meta.fields:
+        related = field.rel and field.rel.to
+        if (isinstance(field, models.ForeignKey)
+                and get_history_manager_name(related)
+                and field.rel.field_name == related._meta.pk.name):
+            attrs['history_fk_fields'].append(field)
+            attrs[field.name] = HistoricalForeignKeyDescriptor(field)
+    for name in getattr(model, 'm2m_history_fields', []):
+        field = model._meta.get_field(name)
+        attrs['history_m2m_fields'].append(field)
+        attrs[name] = HistoricalManyToManyDescriptor(field, getattr(model, name))
+    new_class = type('%s_as_of_managed' % model.__name__, (model,), attrs)
+    # Saving a proxy instance sends signals with the proxy as sender, so
+    # reverting to an as_of_related() instance has to be recorded as well.
+    records = getattr(model._meta, 'simple_history_records', None)
+    if records is not None:
+        models.signals.post_save.connect(records.post_save, sender=new_class,
+                                         weak=False)
+        models.signals.post_delete.connect(records.post_delete, sender=new_class,
+                                           weak=False)
+    return _as_of_related_classes.setdefault(model, new_class)
+
+
+def as_of_related_instance(instance, history_date):
+    """
+    Returns a copy of the historical `instance` whose relations to
+    SimpleHistory-managed models resolve to their versions on `history_date`.
+    """
+    if getattr(instance, 'as_of_related', False):
+        return instance
+    new_class = as_of_related_class(instance.__class__)
+    new_instance = new_class(*[getattr(instance, field.attname)
+                               for field in instance._meta.fields])
+    new_instance._history_date = history_date
+    return new_instance
+
+
+def get_as_of_related(model, history_date, pks, chunk_size=500):
+    """
+    Returns a dictionary mapping the given primary keys of `model` to their
+    as_of_related() instances on `history_date`. Models without history are
+    read from their live table.
+    """
+    manager_name = get_history_manager_name(model)
+    if manager_name is None:
+        pks = list(pks)
+        return dict((obj.pk, obj) for i in range(0, len(pks), chunk_size)
+                    for obj in model._default_manager.filter(pk__in=pks[i:i + chunk_size]))
+    manager = getattr(model, manager_name)
+    return dict((obj.pk, as_of_related_instance(obj, history_date))
+                for obj in manager.as_of_many(history_date, pks=pks,
+                                              chunk_size=chunk_size))
+
+
+def prefetch_as_of_related(instances, fields=None, chunk_size=500):
+    """
+    Fetches the historical ForeignKey targets and `m2m_history_fields`
+    members of as_of_related() `instances`, with one query per related
+    model (and through model) and history date, for every `chunk_size`
+    primary keys. `fields` restricts the relations to fetch to the given
+    names.
+    """
+    groups = defaultdict(list)
+    for instance in instances:
+        groups[instance.__class__, instance._history_date].append(instance)
+    for (new_class, history_date), group in groups.items():
+        fields_by_model = defaultdict(list)
+        for field in new_class.history_fk_fields:
+            if fields is None or field.name in fields:
+                fields_by_model[field.rel.to].append(field)
+        for related, related_fields in fields_by_model.items():
+            pks = set(getattr(instance, field.attname)
+                      for instance in group for field in related_fields)
+            pks.discard(None)
+            found = get_as_of_related(related, history_date, pks, chunk_size)
+            for instance in group:
+                for field in related_fields:
+                    cache_name = new_class.__dict__[field.name].cache_name
+                    instance.__dict__[cache_name] = found.get(getattr(instance, field.attname))
 
+        for field in new_class.history_m2m_fields:
+            if fields is not None and field.name not in fields:
+                continue
+            through = field.rel.through
+            source = through._meta.get_field(field.m2m_field_name()).attname
+            target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+            members = getattr(through, get_history_manager_name(through)).snapshot(history_date)
+            members = members.order_by('history_id').values_list(source, target)
+            pks = [instance.pk for instance in group]
+            pairs = [pair for i in range(0, len(pks), chunk_size)
+                     for pair in members.filter(**{source + '__in': pks[i:i + chunk_size]})]
+            found = get_as_of_related(field.rel.to, history_date,
+                                      set(target_pk for source_pk, target_pk in pairs),
+                                      chunk_size)
+            by_source = defaultdict(list)
+            for source_pk, target_pk in pairs:
+                if target_pk in found:
+                    by_source[source_pk].append(found[target_pk])
+            cache_name = new_class.__dict__[field.name].cache_name
+            for instance in group:
+                instance.__dict__[cache_name] = HistoricalRelatedList(
+                    field.rel.to, by_source[instance.pk])
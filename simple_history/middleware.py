@@ -0,0 +1,38 @@
+import logging
+import threading
+import instrumentation
+
+logger = logging.getLogger('simple_history.instrumentation')
+
+_state = threading.local()
+
+
+def request_listener(event):
+    aggregator = getattr(_state, 'aggregator', None)
+    if aggregator is not None:
+        aggregator(event)
+
+
+class HistoryInstrumentationMiddleware(object):
+    """
+    Sums up the time, queries and rows history tracking added to every
+    request. The summary is logged to the 'simple_history.instrumentation'
+    logger and available as `request.history_instrumentation`, an
+    instrumentation.Aggregator.
+    """
+    def __init__(self):
+        instrumentation.add_listener(request_listener)
+
+    def process_request(self, request):
+        request.history_instrumentation = _state.aggregator = instrumentation.Aggregator()
+
+    def process_response(self, request, response):
+        aggregator = getattr(request, 'history_instrumentation', None)
+        _state.aggregator = None
+        if aggregator is not None:
+            total = aggregator.summary()['total']
+            if total['calls']:
+                logger.info('%s %s: %d history calls, %.1f ms, %d queries, %d rows',
+                            request.method, request.path, total['calls'],
+                            total['time'] * 1000, total['queries'], total['rows'])
+        return response
@@ -1,13 +1,81 @@
 import copy
 import datetime
-from django.db import models
+from django.db import connections, models, transaction
+from django.db.models.deletion import Collector
+from django.db.models.sql import UpdateQuery
+from django.db.models.sql.expressions import SQLEvaluator
 from django.contrib import admin
 from django.contrib.auth.models import User
 from django.utils import importlib
-from manager import HistoryDescriptor
+from manager import (FieldPlan, HistoryDescriptor, HistoryManager, get_history_db,
+                     rebuild_values)
+from batch import current_batch, deferred_batch, history_batch
+from partitions import PartitionSet
+from instrumentation import instrumented
+import cache
+import instrumentation
+import writer
 import simple_history
 
+def original_model(records):
+    return records.history_model.instance_type
+
+def typed_placeholder(field, connection, sql='%s'):
+    """
+    Returns the placeholder of a `field` value in a SELECT list or CASE
+    expression, whose type PostgreSQL doesn't infer from the column it ends
+    up in.
+    """
+    if connection.vendor == 'postgresql':
+        return 'CAST(%s AS %s)' % (sql, field.db_type(connection))
+    return sql
+
+def bulk_update(model, objs, attnames, using, chunk_size=500):
+    """
+    Writes the values of `attnames` of `objs` to their rows with one
+    UPDATE ... SET column = CASE pk ... END per `chunk_size` objects.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    pk = model._meta.pk
+    fields = [field for field in model._meta.concrete_fields if field.attname in attnames
+              and not field.primary_key]
+    if not fields:
+        return
+    # Every object takes two parameters per field, and one for the IN list.
+    chunk_size = min(chunk_size, connection.ops.bulk_batch_size(
+        [None] * (2 * len(fields) + 1), objs))
+    cursor = connection.cursor()
+    for i in range(0, len(objs), chunk_size):
+        chunk = objs[i:i + chunk_size]
+        pks = [pk.get_db_prep_value(obj.pk, connection) for obj in chunk]
+        assignments, params = [], []
+        for field in fields:
+            case = 'WHEN %%s THEN %s' % typed_placeholder(field, connection)
+            assignments.append('%s = CASE %s %s END' % (
+                qn(field.column), qn(pk.column), ' '.join([case] * len(chunk))))
+            for obj_pk, obj in zip(pks, chunk):
+                params.extend([obj_pk, field.get_db_prep_save(getattr(obj, field.attname),
+                                                              connection=connection)])
+        cursor.execute('UPDATE %s SET %s WHERE %s IN (%s)' % (
+            qn(model._meta.db_table), ', '.join(assignments), qn(pk.column),
+            ', '.join(['%s'] * len(pks))), params + pks)
+
 class HistoricalRecords(object):
+    def __init__(self, fields=None, exclude=(), indexes=(), checkpoint_every=None,
+                 skip_unchanged=False, retention=None, using=None, partition_by=None):
+        self.fields = fields
+        self.exclude = exclude
+        self.indexes = tuple(indexes)
+        self.checkpoint_every = checkpoint_every
+        self.skip_unchanged = skip_unchanged
+        self.retention = retention
+        self.using = using
+        self.partition_by = partition_by
+        if checkpoint_every and partition_by:
+            raise ValueError("checkpoint_every can't be combined with partition_by.")
+        self._m2m_fields = {}
+
     def contribute_to_class(self, cls, name):
         self.manager_name = name
         self.module = cls.__module__
@@ -35,7 +103,12 @@ class HistoricalRecords(object):
                     simple_history.register(field.rel.through)
 
     def finalize(self, sender, **kwargs):
+        self.tracked_attnames = [field.attname for field in self.get_tracked_fields(sender)]
         history_model = self.create_history_model(sender)
+        self.history_model = history_model
+        if self.partition_by:
+            history_model.history_partitions = PartitionSet(
+                self, sender, history_model, self.partition_by)
         module = importlib.import_module(self.module)
         setattr(module, history_model.__name__, history_model)
 
@@ -47,32 +120,58 @@ class HistoricalRecords(object):
                                            weak=False)
         models.signals.m2m_changed.connect(self.m2m_changed, sender=sender,
                                            weak=False)
+        if self.skip_unchanged:
+            models.signals.post_init.connect(self.post_init, sender=sender,
+                                             weak=False)
+            models.signals.pre_save.connect(self.pre_save, sender=sender,
+                                            weak=False)
 
         descriptor = HistoryDescriptor(history_model)
         setattr(sender, self.manager_name, descriptor)
         sender._meta.simple_history_manager_attribute = self.manager_name
+        sender._meta.simple_history_records = self
 
-    def create_history_model(self, model):
+    def create_history_model(self, model, partition=None):
         """
-        Creates a historical model to associate with the model provided.
+        Creates a historical model to associate with the model provided,
+        or the model of one of its partitions, see partitions.PartitionSet.
         """
         attrs = {'__module__': self.module}
 
         fields = self.copy_fields(model)
         attrs.update(fields)
-        attrs.update(self.get_extra_fields(model, fields))
-        attrs.update(Meta=type('Meta', (), self.get_meta_options(model)))
+        attrs.update(self.get_extra_fields(model, fields, partition))
+        attrs.update(Meta=type('Meta', (), self.get_meta_options(model, partition)))
         name = 'Historical%s' % model._meta.object_name
+        if partition is not None:
+            name = str('%s_p%s' % (name, partition))
         return type(name, (models.Model,), attrs)
 
+    def get_tracked_fields(self, model):
+        """
+        Returns the fields of `model` whose values are recorded, according
+        to the `fields` and `exclude` options. The primary key is always
+        recorded.
+        """
+        tracked = []
+        for field in model._meta.fields:
+            names = (field.name, field.attname)
+            if not field.primary_key:
+                if self.fields is not None and not set(names) & set(self.fields):
+                    continue
+                if set(names) & set(self.exclude):
+                    continue
+            tracked.append(field)
+        return tracked
+
     def copy_fields(self, model):
         """
-        Creates copies of the model's original fields, returning
+        Creates copies of the model's tracked fields, returning
         a dictionary mapping field name to copied field object.
         """
         fields = {}
 
-        for field in model._meta.fields:
+        for field in self.get_tracked_fields(model):
             field = copy.copy(field)
             fk = None
 
@@ -106,10 +205,19 @@ class HistoricalRecords(object):
             field.auto_now = False
             field.auto_now_add = False
 
-            if field.primary_key or field.unique:
+            if self.checkpoint_every:
+                # Delta records leave the unchanged fields empty.
+                field.null = True
+
+            if field.primary_key:
+                # The former primary key is indexed together with the
+                # history ordering, see get_meta_options.
+                field.primary_key = False
+                field._unique = False
+                field.db_index = False
+            elif field.unique:
                 # Unique fields can no longer be guaranteed unique,
                 # but they should still be indexed for faster lookups.
-                field.primary_key = False
                 field._unique = False
                 field.db_index = True
             if fk:
@@ -118,7 +226,7 @@ class HistoricalRecords(object):
 
         return fields
 
-    def get_extra_fields(self, model, fields):
+    def get_extra_fields(self, model, fields, partition=None):
         """
         Returns a dictionary of fields that will be added to the historical
         record model, in addition to the ones returned by copy_fields below.
@@ -126,82 +234,412 @@ class HistoricalRecords(object):
         @models.permalink
         def revert_url(self):
             opts = model._meta
+            version = self.history_id
+            if partition is not None:
+                version = '%s-%s' % (partition, version)
             return ('%s:%s_%s_simple_history' %
                     (admin.site.name, opts.app_label, opts.module_name),
-                    [getattr(self, opts.pk.attname), self.history_id])
+                    [getattr(self, opts.pk.attname), version])
         def get_instance(self):
-            return model(**dict([(k, getattr(self, k)) for k in fields]))
+            return self.history_field_plan.build(historical_values(self))
 
         rel_nm = '_%s_history' % model._meta.object_name.lower()
-        return {
+        extra_fields = {
             'history_id': models.AutoField(primary_key=True),
-            'history_date': models.DateTimeField(default=datetime.datetime.now),
+            'history_date': models.DateTimeField(default=datetime.datetime.now, db_index=True),
             'history_type': models.CharField(max_length=1, choices=(
                 ('+', 'Created'),
                 ('~', 'Changed'),
                 ('-', 'Deleted'),
             )),
             'history_object': HistoricalObjectDescriptor(model),
-            'changed_by': models.ForeignKey(User, null=True),
+            'instance_type': model,
+            'history_field_plan': FieldPlan(model, self.tracked_attnames),
+            'history_retention': self.retention,
+            'history_using': self.using,
+            'objects': HistoryManager(),
+            'history_partitions': None,
+            'history_partition_key': partition,
+            'history_partition_of': partition and self.history_model,
+            # Users may live in another database than the historical records,
+            # whose deletion then can't cascade to them.
+            'changed_by': models.ForeignKey(User, null=True,
+                                            db_constraint=self.using is None,
+                                            on_delete=self.using and models.DO_NOTHING
+                                                      or models.CASCADE),
             'instance': property(get_instance),
             'revert_url': revert_url,
             '__unicode__': lambda self: u'%s as of %s' % (self.history_object,
                                                           self.history_date)
         }
+        if self.checkpoint_every:
+            extra_fields.update({
+                'history_delta_fields': models.TextField(null=True, blank=True, editable=False),
+                'history_checkpoint_every': self.checkpoint_every,
+            })
+        return extra_fields
 
-    def get_meta_options(self, model):
+    def get_meta_options(self, model, partition=None):
         """
         Returns a dictionary of fields that will be added to
         the Meta inner class of the historical record model.
         """
+        pk_name = model._meta.pk.attname
         meta_options = {
             'ordering': ('-history_date', '-history_id'),
+            # Lets per-object lookups (as_of, most_recent, the admin history
+            # view) read the records in order straight from the index.
+            'index_together': ((pk_name, 'history_date', 'history_id'),) + self.indexes,
         }
         if hasattr(model._meta, 'app_label'):
             meta_options['app_label'] = model._meta.app_label
+        if partition is not None:
+            meta_options['db_table'] = '%s_p%s' % (self.history_model._meta.db_table, partition)
         return meta_options
 
+    def post_init(self, instance, **kwargs):
+        instance._history_snapshot = self.get_snapshot(instance)
+
+    def pre_save(self, instance, **kwargs):
+        # Only instances loaded from (or saved to) the database have values
+        # known to match their row. Others, like as_of() instances or
+        # instances built with a primary key, are always recorded.
+        if instance._state.db is None:
+            instance.__dict__.pop('_history_snapshot', None)
+
+    def get_snapshot(self, instance):
+        """
+        Returns a tuple of the tracked field values currently loaded on
+        `instance`. Deferred fields are not loaded to build it.
+        """
+        return tuple(map(instance.__dict__.get, self.tracked_attnames))
+
+    @instrumented('post_save', original_model)
     def post_save(self, instance, created, **kwargs):
         if not created and hasattr(instance, 'skip_history_when_saving'):
             return
+        if self.skip_unchanged:
+            snapshot = self.get_snapshot(instance)
+            unchanged = (not created and
+                         getattr(instance, '_history_snapshot', None) == snapshot)
+            instance._history_snapshot = snapshot
+            if unchanged:
+                return
         self.create_historical_record(instance, created and '+' or '~')
 
+    @instrumented('post_delete', original_model)
     def post_delete(self, instance, **kwargs):
         self.create_historical_record(instance, '-')
 
-    def m2m_changed(self, action, instance, sender, **kwargs):
-        source_field_name, target_field_name = None, None
-        for field_name, field_value in sender.__dict__.items():
-            if isinstance(field_value, models.fields.related.ReverseSingleRelatedObjectDescriptor):
-                if field_value.field.related.parent_model == kwargs['model']:
-                    target_field_name = field_name
-                elif field_value.field.related.parent_model == type(instance):
-                    source_field_name = field_name
-        items = sender.objects.filter(**{source_field_name:instance})
-        if kwargs['pk_set']:
-            items = items.filter(**{target_field_name + '__id__in':kwargs['pk_set']})
-        for item in items:
-            if action == 'post_add':
-                if hasattr(item, 'skip_history_when_saving'):
-                    return
-                self.create_historical_record(item, '+')
-            elif action == 'pre_remove':
-                self.create_historical_record(item, '-')
-            elif action == 'pre_clear':
-                self.create_historical_record(item, '-')
+    @instrumented('m2m_changed', original_model)
+    def m2m_changed(self, action, instance, sender, model, pk_set, **kwargs):
+        if action not in ('post_add', 'pre_remove', 'pre_clear'):
+            return
+        if action != 'pre_clear' and not pk_set:
+            return
+        source_field, target_field = self.get_m2m_fields(sender, instance._meta.concrete_model,
+                                                          model)
+        items = sender._default_manager.filter(**{source_field.name: instance})
+        if action != 'pre_clear':
+            items = items.filter(**{target_field.name + '__in': pk_set})
+        attnames = self.tracked_attnames
+        history_type = action == 'post_add' and '+' or '-'
+        changed_by = getattr(instance, '_changed_by_user', None)
+        records = [self.history_model(history_type=history_type,
+                                      changed_by=changed_by,
+                                      **dict(zip(attnames, values)))
+                   for values in items.values_list(*attnames)]
+        self.save_historical_records(records, using=instance._state.db)
+
+    def get_m2m_fields(self, through, source_model, target_model):
+        """
+        Returns the (source, target) ForeignKey fields of the `through`
+        model for a relation from `source_model` to `target_model`.
+        The lookup is cached, since it runs on every m2m_changed signal.
+        """
+        key = (through, source_model, target_model)
+        try:
+            return self._m2m_fields[key]
+        except KeyError:
+            pass
+        source_field, target_field = None, None
+        for field in through._meta.fields:
+            if not isinstance(field, models.ForeignKey):
+                continue
+            if field.rel.to == source_model and source_field is None:
+                source_field = field
+            elif field.rel.to == target_model:
+                target_field = field
+        self._m2m_fields[key] = (source_field, target_field)
+        return source_field, target_field
 
+    @instrumented('create_historical_record', original_model)
     def create_historical_record(self, instance, type):
         changed_by = getattr(instance, '_changed_by_user', None)
+        plan = self.history_model.history_field_plan
+        attrs = dict(zip(plan.tracked, plan.get_values(instance)))
+        if self.checkpoint_every and type == '~':
+            stored = self.get_delta_fields(instance, attrs)
+            if stored is not None:
+                for name in attrs:
+                    if name not in stored:
+                        attrs[name] = None
+                attrs['history_delta_fields'] = ','.join(stored)
+        record = self.history_model(history_type=type, changed_by=changed_by, **attrs)
+        self.save_historical_records([record], using=instance._state.db)
+
+    def create_historical_records(self, instances, type, changed_by=None, using=None):
+        """
+        Records one historical record of `type` per instance, written with
+        a single bulk INSERT (see save_historical_records). `changed_by` is
+        used for the instances that have no `_changed_by_user` of their own.
+        Full records are written even for models using checkpoint_every.
+        """
+        plan = self.history_model.history_field_plan
+        records = []
+        for instance in instances:
+            user = getattr(instance, '_changed_by_user', None) or changed_by
+            records.append(self.history_model(history_type=type, changed_by=user,
+                                              **dict(zip(plan.tracked, plan.get_values(instance)))))
+            if self.skip_unchanged:
+                instance._history_snapshot = self.get_snapshot(instance)
+        self.save_historical_records(records, using=using)
+
+    def can_record_update(self, queryset):
+        """
+        Returns whether the historical records of `queryset.update()` can be
+        copied from the updated table with one INSERT ... SELECT, which
+        needs the history to live in the same database and the tracked
+        fields to live in that one table.
+        """
+        model = queryset.model
+        history_model = self.history_model
+        if self.partition_by:
+            history_model = history_model.history_partitions.model_for_date(datetime.datetime.now())
+        return (not model._meta.parents and
+                get_history_db(history_model) == queryset.db)
+
+    def record_update(self, queryset, values, changed_by=None):
+        """
+        Writes a '~' historical record of every row `queryset.update(**values)`
+        is about to change, holding the values the rows will have once
+        updated, with a single INSERT ... SELECT from the original table.
+        Must run in the same transaction as the update, right before it.
+        Returns the number of records written.
+        """
+        date = datetime.datetime.now()
+        history_model = self.history_model
+        if self.partition_by:
+            history_model = history_model.history_partitions.model_for_date(date)
+        batch = current_batch()
+        if batch is not None:
+            # Buffered records of these objects are older than the ones
+            # written here, so they have to be written first.
+            batch.flush_model(history_model)
+        connection = connections[queryset.db]
+        query = queryset.query.clone(UpdateQuery)
+        query.add_update_values(values)
+        compiler = query.get_compiler(queryset.db)
+        compiler.pre_sql_setup()
+        qn = compiler.quote_name_unless_alias
+        table = query.tables[0]
+
+        updated = {}
+        for field, model, val in query.values:
+            if hasattr(val, 'prepare_database_save'):
+                val = val.prepare_database_save(field)
+            else:
+                val = field.get_db_prep_save(val, connection=connection)
+            if hasattr(val, 'evaluate'):
+                val = SQLEvaluator(val, query, allow_joins=False)
+            if hasattr(val, 'as_sql'):
+                updated[field.attname] = val.as_sql(qn, connection)
+            elif val is not None:
+                sql = '%s'
+                if hasattr(field, 'get_placeholder'):
+                    sql = field.get_placeholder(val, connection)
+                updated[field.attname] = typed_placeholder(field, connection, sql), [val]
+            else:
+                updated[field.attname] = 'NULL', []
+
+        columns, select, params = [], [], []
+        for field in queryset.model._meta.fields:
+            if field.attname not in self.tracked_attnames:
+                continue
+            columns.append(qn(history_model._meta.get_field(field.attname).column))
+            if field.attname in updated:
+                sql, field_params = updated[field.attname]
+                select.append(sql)
+                params.extend(field_params)
+            else:
+                select.append('%s.%s' % (qn(table), qn(field.column)))
+        changed_by_id = changed_by.pk if changed_by is not None else None
+        for name, value in (('history_date', date), ('history_type', '~'),
+                            ('changed_by', changed_by_id)):
+            field = history_model._meta.get_field(name)
+            columns.append(qn(field.column))
+            select.append(typed_placeholder(field, connection))
+            if name == 'history_date':
+                value = field.get_db_prep_value(value, connection)
+            params.append(value)
+        where, where_params = query.where.as_sql(qn=qn, connection=connection)
+        sql = 'INSERT INTO %s (%s) SELECT %s FROM %s' % (
+            qn(history_model._meta.db_table), ', '.join(columns),
+            ', '.join(select), qn(table))
+        if where:
+            sql += ' WHERE %s' % where
+        cursor = connection.cursor()
+        cursor.execute(sql, params + list(where_params))
+        cache.invalidate_model(history_model.history_partition_of or history_model, date)
+        return cursor.rowcount
+
+    def revert_to(self, date, pks, changed_by=None, using=None, chunk_size=500):
+        """
+        Reverts the objects with the given primary keys to their state as
+        of `date` in one transaction, see HistoryManager.revert_to().
+        """
+        model = self.history_model.instance_type
+        if model._meta.parents:
+            raise ValueError("revert_to() can't bulk revert %s, which inherits "
+                             "from another model." % model._meta.object_name)
+        manager = model._default_manager.db_manager(using)
+        using = manager.db
+        history = getattr(model, self.manager_name)
+        attnames = list(self.tracked_attnames)
+        pk_name = model._meta.pk.attname
+        plan = self.history_model.history_field_plan
+        result = {'created': [], 'updated': [], 'deleted': []}
+        with history_batch(using=using):
+            for i in range(0, len(pks), chunk_size):
+                chunk = pks[i:i + chunk_size]
+                states = dict((obj.pk, obj) for obj in history.as_of_many(date, chunk))
+                live = dict((values[0], values[1:]) for values in manager.filter(
+                    **{pk_name + '__in': chunk}).values_list(pk_name, *attnames))
+                created = [obj for pk, obj in states.items() if pk not in live]
+                updated = [obj for pk, obj in states.items()
+                           if pk in live and live[pk] != tuple(plan.get_values(obj))]
+                deleted = [pk for pk in live if pk not in states]
+                if deleted:
+                    # post_delete records the deletions into the batch.
+                    objs = list(manager.filter(**{pk_name + '__in': deleted}))
+                    for obj in objs:
+                        obj._changed_by_user = changed_by
+                    collector = Collector(using=using)
+                    collector.collect(objs)
+                    collector.delete()
+                if updated:
+                    bulk_update(model, updated, attnames, using)
+                    self.create_historical_records(updated, '~', changed_by, using=using)
+                if created:
+                    # Not through the manager, which may record history itself.
+                    models.query.QuerySet(model, using=using).bulk_create(created)
+                    self.create_historical_records(created, '+', changed_by, using=using)
+                result['created'].extend(obj.pk for obj in created)
+                result['updated'].extend(obj.pk for obj in updated)
+                result['deleted'].extend(deleted)
+        return result
+
+    def get_delta_fields(self, instance, attrs):
+        """
+        Returns the names of the fields a delta record for `instance` has to
+        store, i.e. its primary key and the fields that changed since its
+        previous record. Returns None when a full record is due instead,
+        which happens every `checkpoint_every` records.
+        """
+        pk_name = instance._meta.pk.attname
+        fields = self.tracked_attnames
         manager = getattr(instance, self.manager_name)
-        attrs = {}
-        for field in instance._meta.fields:
-            attrs[field.attname] = getattr(instance, field.attname)
-        manager.create(history_type=type, changed_by=changed_by, **attrs)
+
+        def previous_records():
+            # Records still waiting in a history_batch(), or for the
+            # transaction to commit, are newer than the ones in the database.
+            batch = current_batch() or deferred_batch(instance._state.db)
+            if batch is not None:
+                for record in reversed(batch.pending(self.history_model, instance.pk)):
+                    yield dict((name, getattr(record, name))
+                               for name in fields + ['history_delta_fields'])
+            for row in manager.values('history_delta_fields', *fields)[:self.checkpoint_every]:
+                yield row
+
+        values, count = rebuild_values(previous_records(), fields)
+        if not count or count >= self.checkpoint_every or len(values) < len(fields):
+            return None
+        return [name for name in fields
+                if name == pk_name or attrs[name] != values[name]]
+
+    def save_historical_records(self, records, using=None):
+        """
+        Writes unsaved historical records, either into the active
+        history_batch(), the background writer or straight to the database
+        of the history model. `using` is the database of the change they
+        record.
+        """
+        if not records:
+            return
+        if instrumentation.listeners:
+            instrumentation.add_rows(len(records))
+        if self.partition_by:
+            records = self.partition_records(records)
+        cache.invalidate_records(records)
+        batch = current_batch()
+        if batch is None and get_history_db(records[0].__class__) != \
+                transaction.get_connection(using).alias:
+            # Written once the transaction they're part of commits.
+            batch = deferred_batch(using, create=True)
+        if batch is not None:
+            batch.extend(records)
+            return
+        background = writer.get_writer()
+        if (background is not None and not self.checkpoint_every
+                and not transaction.get_connection(using).in_atomic_block):
+            records = background.put(records)
+            if not records:
+                return
+        if len(records) == 1:
+            records[0].save(force_insert=True, using=get_history_db(records[0].__class__))
+            return
+        # Records of a partitioned model may span several partitions.
+        by_model = {}
+        for record in records:
+            by_model.setdefault(record.__class__, []).append(record)
+        for model, rows in by_model.items():
+            model._default_manager.bulk_create(rows)
+
+    def partition_records(self, records):
+        """
+        Returns copies of the historical records as instances of the
+        models of the partitions their dates fall in.
+        """
+        partitions = self.history_model.history_partitions
+        fields = [field.attname for field in self.history_model._meta.concrete_fields
+                  if field.name != 'history_id']
+        return [partitions.model_for_date(record.history_date)(
+                    **dict((name, getattr(record, name)) for name in fields))
+                for record in records]
 
 class HistoricalObjectDescriptor(object):
     def __init__(self, model):
         self.model = model
 
     def __get__(self, instance, owner):
-        values = (getattr(instance, f.attname) for f in self.model._meta.fields)
-        return self.model(*values)
+        return instance.history_field_plan.build(historical_values(instance))
+
+def historical_values(record):
+    """
+    Returns the tracked field values of the original object stored by the
+    historical `record`, in the order of its field plan. Delta
+    records are completed from the records before them, unless their
+    queryset already did, see HistoricalQuerySet.complete_deltas().
+    """
+    plan = record.history_field_plan
+    if getattr(record, 'history_delta_fields', None) is None:
+        return plan.get_values(record)
+    if hasattr(record, '_history_values'):
+        return record._history_values
+    pk_name = plan.model._meta.pk.attname
+    qs = HistoryManager(record.__class__).filter(
+        models.Q(history_date__lt=record.history_date) |
+        models.Q(history_date=record.history_date, history_id__lte=record.history_id),
+        **{pk_name: getattr(record, pk_name)})
+    history_type, values = qs.latest_values(plan.tracked)
+    return values
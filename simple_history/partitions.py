@@ -0,0 +1,268 @@
+"""
+Time-partitioned historical tables.
+
+With HistoricalRecords(partition_by='month') (or 'year'), historical
+records are written to one table per period, named after the historical
+model's table with a `_pYYYYMM` (or `_pYYYY`) suffix, e.g.
+`polls_historicalpoll_p201303`. Each period gets its own historical model,
+created on demand, and the regular historical model's table keeps the
+records written before partitioning was turned on.
+
+Tables are created the first time a record is written in their period.
+Since that may happen inside a transaction, it's better to create them
+ahead of time, e.g. from a scheduled job:
+
+    Poll.history.create_partition(next_month)
+"""
+import datetime
+import threading
+import time
+from django.core.management.color import no_style
+from django.db import connections, transaction, DatabaseError
+from manager import HistoryManager, get_history_db
+import commit_hooks
+
+PERIODS = {
+    'year': '%Y',
+    'month': '%Y%m',
+}
+
+
+class PartitionSet(object):
+    """
+    The per-period historical models of one partitioned historical model.
+
+    The keys of the existing tables are cached. Reads naming a period
+    without a table only reload them every `refresh_interval` seconds, in
+    case another process created it. Tables created inside a transaction
+    only count as existing for other threads once it commits.
+    """
+    refresh_interval = 60
+
+    def __init__(self, records, model, history_model, partition_by):
+        if partition_by not in PERIODS:
+            raise ValueError("partition_by must be one of %s, not %r." %
+                             (', '.join(sorted(PERIODS)), partition_by))
+        self.records = records
+        self.model = model
+        self.history_model = history_model
+        self.partition_by = partition_by
+        self.models = {}
+        self.existing = None
+        self.refreshed_at = None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def key_for(self, date):
+        return date.strftime(PERIODS[self.partition_by])
+
+    def start_of(self, key):
+        """
+        Returns the first moment of the period identified by `key`.
+        """
+        return datetime.datetime.strptime(key, PERIODS[self.partition_by])
+
+    def end_of(self, key):
+        """
+        Returns the first moment after the period identified by `key`.
+        """
+        start = self.start_of(key)
+        if self.partition_by == 'year':
+            return start.replace(year=start.year + 1)
+        if start.month == 12:
+            return start.replace(year=start.year + 1, month=1)
+        return start.replace(month=start.month + 1)
+
+    def get_model(self, key):
+        """
+        Returns the historical model of the period identified by `key`.
+        """
+        with self.lock:
+            if key not in self.models:
+                self.models[key] = self.records.create_history_model(
+                    self.model, partition=key)
+            return self.models[key]
+
+    @property
+    def db(self):
+        return get_history_db(self.history_model)
+
+    def table_prefix(self):
+        return '%s_p' % self.history_model._meta.db_table
+
+    def refresh(self):
+        """
+        Reloads the list of existing partition tables from the database.
+        """
+        prefix = self.table_prefix()
+        tables = connections[self.db].introspection.table_names()
+        # Table names are unicode, but keys end up in class names.
+        keys = set(str(table[len(prefix):]) for table in tables
+                   if table.startswith(prefix) and table[len(prefix):].isdigit())
+        with self.lock:
+            self.existing = keys
+            self.refreshed_at = time.time()
+        return keys
+
+    def uncommitted_keys(self):
+        """
+        Returns the keys of the tables this thread created in the
+        transaction still open on the history database.
+        """
+        return set(getattr(self.local, 'created', {}))
+
+    def existing_keys(self, until=None):
+        """
+        Returns the keys of the existing partitions, newest first, stopping
+        at the period of `until` if given.
+        """
+        keys = self.existing
+        if keys is None or (until is not None and self.key_for(until) not in keys and
+                            time.time() - self.refreshed_at >= self.refresh_interval):
+            keys = self.refresh()
+        keys = keys | self.uncommitted_keys()
+        if until is not None:
+            last = self.key_for(until)
+            keys = [key for key in keys if key <= last]
+        return sorted(keys, reverse=True)
+
+    def models_until(self, until=None):
+        """
+        Returns the historical models to search for records dated up to
+        `until`, newest first, ending with the unpartitioned model.
+        """
+        return [self.get_model(key) for key in self.existing_keys(until)] + [self.history_model]
+
+    def create(self, key):
+        """
+        Creates the table of the period identified by `key` if it doesn't
+        exist yet, and returns its historical model.
+        """
+        model = self.get_model(key)
+        if self.existing is None:
+            self.refresh()
+        if key in self.existing or key in self.uncommitted_keys():
+            return model
+        connection = connections[self.db]
+        style = no_style()
+        statements, pending = connection.creation.sql_create_model(model, style)
+        statements.extend(connection.creation.sql_indexes_for_model(model, style))
+        try:
+            with transaction.atomic(using=self.db):
+                cursor = connection.cursor()
+                for statement in statements:
+                    cursor.execute(statement)
+        except DatabaseError:
+            # Another process may have created it in the meantime.
+            if key not in self.refresh():
+                raise
+        if connection.in_atomic_block:
+            # The table goes away if the transaction rolls back.
+            self.created_in_transaction(key)
+        else:
+            with self.lock:
+                self.existing.add(key)
+        return model
+
+    def created_in_transaction(self, key):
+        created = self.local.__dict__.setdefault('created', {})
+        if not getattr(self.local, 'listening', False):
+            commit_hooks.add_commit_listener(self.committed, using=self.db)
+            commit_hooks.add_rollback_listener(self.rolled_back, using=self.db)
+            self.local.listening = True
+        created[key] = commit_hooks.savepoint_ids(self.db)
+
+    def committed(self):
+        keys = self.end_transaction()
+        with self.lock:
+            if self.existing is not None:
+                self.existing.update(keys)
+
+    def rolled_back(self, sid):
+        created = self.local.created
+        dropped = [key for key, savepoints in created.items()
+                   if sid is None or sid in savepoints]
+        for key in dropped:
+            del created[key]
+        if dropped:
+            # The keys may have been reloaded from inside the transaction.
+            with self.lock:
+                self.existing = None
+        if sid is None:
+            self.end_transaction()
+
+    def end_transaction(self):
+        commit_hooks.remove_commit_listener(self.committed, using=self.db)
+        commit_hooks.remove_rollback_listener(self.rolled_back, using=self.db)
+        self.local.listening = False
+        created, self.local.created = self.local.created, {}
+        return set(created)
+
+    def model_for_date(self, date):
+        """
+        Returns the historical model records dated `date` are written to,
+        creating its table if needed.
+        """
+        key = self.key_for(date)
+        if self.existing is not None and key in self.existing:
+            return self.get_model(key)
+        return self.create(key)
+
+    def drop(self, key):
+        """
+        Drops the table of the period identified by `key`.
+        """
+        model = self.get_model(key)
+        connection = connections[self.db]
+        cursor = connection.cursor()
+        cursor.execute('DROP TABLE %s' % connection.ops.quote_name(model._meta.db_table))
+        with self.lock:
+            if self.existing is not None:
+                self.existing.discard(key)
+
+    def drop_before(self, cutoff):
+        """
+        Drops the partitions whose period ended before `cutoff`. The latest
+        record of every object in them is first copied to the partition of
+        `cutoff`, unless that partition already has a record of the object
+        dated before `cutoff`, so that as_of(cutoff) keeps working.
+        Returns the number of records dropped.
+        """
+        keys = [key for key in self.existing_keys() if self.end_of(key) <= cutoff]
+        if not keys:
+            return 0
+        pk_name = self.model._meta.pk.attname
+        target = self.create(self.key_for(cutoff))
+        seen = set(target._default_manager.filter(history_date__lt=cutoff)
+                   .values_list(pk_name, flat=True).distinct())
+        deletions = []
+        latest = []
+        dropped = 0
+        for key in keys:
+            model = self.get_model(key)
+            dropped += model._default_manager.count()
+            for record in HistoryManager(model)._latest_as_of(cutoff).iterator():
+                pk = getattr(record, pk_name)
+                if pk in seen:
+                    continue
+                seen.add(pk)
+                if record.history_type == '-':
+                    deletions.append(record)
+                else:
+                    latest.append(record)
+        # A deletion only needs to be kept if older records of the object
+        # remain in the unpartitioned table.
+        pks = [getattr(record, pk_name) for record in deletions]
+        older = set()
+        for i in range(0, len(pks), 500):
+            older.update(self.history_model._default_manager.filter(
+                **{pk_name + '__in': pks[i:i + 500]}).values_list(pk_name, flat=True))
+        latest.extend(record for record in deletions if getattr(record, pk_name) in older)
+        fields = [field.attname for field in target._meta.concrete_fields
+                  if field.name != 'history_id']
+        target._default_manager.bulk_create(
+            [target(**dict((name, getattr(record, name)) for name in fields))
+             for record in latest])
+        for key in keys:
+            self.drop(key)
+        return dropped - len(latest)
@@ -0,0 +1,28 @@
+from django.db import DEFAULT_DB_ALIAS
+
+
+class HistoryRouter(object):
+    """
+    Keeps historical models in the database given by the `using` option of
+    HistoricalRecords, and only creates their tables there. Relations
+    followed from historical records (e.g. `changed_by`) are read from the
+    default database.
+
+    Add 'simple_history.routers.HistoryRouter' to DATABASE_ROUTERS.
+    """
+    def db_for_read(self, model, **hints):
+        using = getattr(model, 'history_using', None)
+        if using:
+            return using
+        instance = hints.get('instance')
+        if getattr(instance, 'history_using', None):
+            return DEFAULT_DB_ALIAS
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_syncdb(self, db, model):
+        using = getattr(model, 'history_using', None)
+        if using:
+            return db == using
+        return None
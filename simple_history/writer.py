@@ -0,0 +1,235 @@
+"""
+Optional background writer for historical records.
+
+Once started, historical records created outside of a transaction are put
+on a bounded in-process queue and written by a worker thread, in batches
+of one bulk INSERT per history model:
+
+    from simple_history import writer
+    writer.start(batch_size=500, flush_interval=1.0)
+
+Records created in a history_batch() are queued after its transaction
+commits. Records created in any other transaction, and records of models
+storing deltas, are still written synchronously, so they can't outlive a
+rollback or be diffed against a record that isn't written yet.
+
+The queue is flushed when the process exits cleanly. Call `flush()` to
+wait until every queued record is written, e.g. in tests or at the end
+of a management command.
+
+Stale connections are closed before every batch, and failed batches are
+retried on a new connection. Records that still can't be written are
+kept in the writer's `failed` list rather than dropped; see
+`retry_failed()`.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+from Queue import Queue, Empty, Full
+from django.db import close_old_connections, connections
+from manager import get_history_db
+import cache
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class BackgroundWriter(object):
+    def __init__(self, batch_size=500, flush_interval=1.0, max_queue_size=10000,
+                 block=True, retries=3, retry_delay=1.0):
+        """
+        batch_size -- maximum number of records written per batch
+        flush_interval -- seconds to wait for more records before writing
+                          a partial batch
+        max_queue_size -- maximum number of records waiting to be written
+        block -- whether to wait for room when the queue is full, rather
+                 than writing the records synchronously
+        retries -- how many more times a failed batch is written, on a new
+                   connection, before its records are written one by one
+        retry_delay -- seconds to wait before retrying
+        """
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.block = block
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = Queue(max_queue_size)
+        self.thread = None
+        self.failed = []
+        self.lock = threading.Lock()
+        self._attnames = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,
+                                       name='simple_history writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Writes the queued records and stops the worker thread.
+        """
+        self.queue.put(_STOP)
+        self.thread.join()
+
+    def flush(self):
+        """
+        Blocks until every queued record has been written.
+        """
+        self.queue.join()
+
+    def get_attnames(self, model):
+        try:
+            return self._attnames[model]
+        except KeyError:
+            attnames = self._attnames[model] = tuple(
+                field.attname for field in model._meta.concrete_fields
+                if field.name != 'history_id')
+            return attnames
+
+    def put(self, records):
+        """
+        Queues unsaved historical records as tuples of their values.
+        Returns the records that didn't fit in the queue, which the caller
+        has to write itself.
+        """
+        for i, record in enumerate(records):
+            model = record.__class__
+            values = tuple(getattr(record, attname)
+                           for attname in self.get_attnames(model))
+            try:
+                self.queue.put((model, values), block=self.block)
+            except Full:
+                return records[i:]
+        return []
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            items = [item]
+            stop = item is _STOP
+            while not stop and len(items) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=self.flush_interval)
+                except Empty:
+                    break
+                items.append(item)
+                stop = item is _STOP
+            try:
+                self.write([item for item in items if item is not _STOP])
+            finally:
+                for item in items:
+                    self.queue.task_done()
+            if stop:
+                for connection in connections.all():
+                    connection.close()
+                return
+
+    def write(self, items):
+        # The worker's connections may have timed out between batches.
+        close_old_connections()
+        rows = defaultdict(list)
+        order = []
+        for model, values in items:
+            if model not in rows:
+                order.append(model)
+            rows[model].append(model(**dict(zip(self.get_attnames(model), values))))
+        for model in order:
+            self.write_records(model, rows[model])
+
+    def write_records(self, model, records):
+        """
+        Writes historical records of `model` with one bulk INSERT, retrying
+        on a new connection. If that keeps failing, they're written one by
+        one, so that a bad record doesn't take the others down with it, and
+        the records that still fail are added to `failed`.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                model._default_manager.bulk_create(records)
+            except Exception:
+                logger.warning('Could not write %d %s records (attempt %d of %d)',
+                               len(records), model._meta.object_name, attempt + 1,
+                               self.retries + 1, exc_info=True)
+                connections[get_history_db(model)].close()
+                if attempt < self.retries:
+                    time.sleep(self.retry_delay)
+            else:
+                cache.invalidate_records(records)
+                return
+        for record in records:
+            try:
+                record.save(force_insert=True, using=get_history_db(model))
+            except Exception:
+                logger.exception('Could not write a %s record, keeping it in the '
+                                 'failed records', model._meta.object_name)
+                connections[get_history_db(model)].close()
+                with self.lock:
+                    self.failed.append(record)
+            else:
+                cache.invalidate_records([record])
+
+    def retry_failed(self):
+        """
+        Writes the records that couldn't be written so far, in the calling
+        thread. Returns the number of records that still failed.
+        """
+        with self.lock:
+            records, self.failed = self.failed, []
+        by_model = defaultdict(list)
+        for record in records:
+            by_model[record.__class__].append(record)
+        for model, rows in by_model.items():
+            self.write_records(model, rows)
+        return len(self.failed)
+
+
+_writer = None
+_lock = threading.Lock()
+
+
+def start(**options):
+    """
+    Starts the background writer, see BackgroundWriter for the options.
+    """
+    global _writer
+    with _lock:
+        if _writer is None:
+            _writer = BackgroundWriter(**options)
+            _writer.start()
+    return _writer
+
+
+def stop():
+    """
+    Writes the queued records and stops the background writer.
+    """
+    global _writer
+    with _lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+        if writer.failed and writer.retry_failed():
+            logger.error('%d historical records could not be written', len(writer.failed))
+
+
+def flush():
+    """
+    Blocks until every queued record has been written.
+    """
+    writer = _writer
+    if writer is not None:
+        writer.flush()
+
+
+def get_writer():
+    """
+    Returns the running BackgroundWriter, or None.
+    """
+    return _writer
+
+
+atexit.register(stop)